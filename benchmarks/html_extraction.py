@@ -0,0 +1,82 @@
+"""
+Compare the HTML-to-text engines behind :func:`matchwell.gmail.html_to_text`.
+
+Builds a corpus shaped like the HTML-only newsletters that make up most of
+our mail: table layouts, inline and embedded CSS, tracking pixels, entities
+and a footer of links. Usage::
+
+    python benchmarks/html_extraction.py [n_messages]
+"""
+import random
+import sys
+import timeit
+
+from matchwell.gmail import html_to_text
+
+WORDS = ('update release sale offer weekly digest team project launch '
+         'meeting invoice account security review notes travel '
+         'discount members event webinar').split()
+
+
+def sentence(rng, n=12):
+    return ' '.join(rng.choice(WORDS) for _ in range(n)).capitalize() + '.'
+
+
+def newsletter(rng, sections=8):
+    """An HTML document resembling a marketing newsletter."""
+    rows = []
+    for i in range(sections):
+        rows.append(
+            '<tr><td class="section" style="padding:12px;'
+            'font-family:Helvetica,Arial,sans-serif;color:#333333">'
+            '<h2 style="margin:0">%s</h2>'
+            '<p>%s %s &amp; more&nbsp;&raquo;</p>'
+            '<a href="https://example.com/track?id=%d&amp;u=%d" '
+            'style="color:#1a73e8">Read more</a>'
+            '<img src="https://example.com/img/%d.png" width="600" alt="">'
+            '</td></tr>' % (sentence(rng, 5), sentence(rng), sentence(rng),
+                            i, rng.randint(0, 1 << 30), i))
+    return (
+        '<!DOCTYPE html><html><head><meta charset="utf-8">'
+        '<title>%s</title><style type="text/css">%s</style>'
+        '<script>window.dataLayer=[{"campaign":%d}];</script></head>'
+        '<body><!--[if mso]><table><tr><td><![endif]-->'
+        '<table width="100%%" cellpadding="0" cellspacing="0">%s</table>'
+        '<div class="footer"><a href="#">Unsubscribe</a> | '
+        '<a href="#">View in browser</a></div>'
+        '<img src="https://example.com/open.gif" width="1" height="1">'
+        '</body></html>' % (
+            sentence(rng, 4),
+            ' '.join('.c%d{margin:0;padding:%dpx}' % (i, i)
+                     for i in range(40)),
+            rng.randint(0, 1 << 30),
+            ''.join(rows)))
+
+
+def normalize(text):
+    return ' '.join(text.split())
+
+
+def main(n=500):
+    rng = random.Random(42)
+    corpus = [newsletter(rng, sections=rng.randint(3, 15)) for _ in range(n)]
+    size = sum(len(doc) for doc in corpus) / 1024 ** 2
+    print("%d messages, %.1f MiB of HTML" % (n, size))
+
+    timings = {}
+    for engine in ('bs4', 'fast'):
+        timings[engine] = min(timeit.repeat(
+            lambda: [html_to_text(doc, engine) for doc in corpus],
+            number=1, repeat=3))
+        print("%-5s %.3f s  (%.0f messages/s)" %
+              (engine, timings[engine], n / timings[engine]))
+    print("fast is %.1fx quicker" % (timings['bs4'] / timings['fast']))
+
+    mismatched = sum(
+        normalize(html_to_text(doc, 'fast')) !=
+        normalize(html_to_text(doc, 'bs4')) for doc in corpus)
+    print("%d of %d messages extracted differently" % (mismatched, n))
+
+
+if __name__ == '__main__':
+    main(*(int(a) for a in sys.argv[1:]))
@@ -0,0 +1,172 @@
+"""
+cache
+=====
+A persistent, size-bounded store of downloaded messages, keyed by ID.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+DEFAULT_PATH = os.path.join(
+    os.path.expanduser('~'), '.cache', 'matchwell', 'messages.sqlite')
+
+
+class MessageCache:
+    """Keeps Gmail message resources on disk, keyed by message ID.
+
+    A message's body never changes once sent, so bodies stay until they're
+    evicted for space, least recently used first. Label IDs do change, so
+    they're kept apart from bodies and can be invalidated on their own.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, max_bytes=2 * 1024 ** 3):
+        """
+        Args:
+            path (str): SQLite database file; created if missing.
+            max_bytes (int): Upper bound on compressed message bodies.
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS bodies ('
+                ' id TEXT PRIMARY KEY,'
+                ' data BLOB NOT NULL,'
+                ' size INTEGER NOT NULL,'
+                ' accessed REAL NOT NULL)')
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS bodies_accessed'
+                ' ON bodies (accessed)')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS labels ('
+                ' id TEXT PRIMARY KEY,'
+                ' label_ids TEXT NOT NULL)')
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM bodies').fetchone()[0]
+
+    def __contains__(self, msg_id):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT 1 FROM bodies WHERE id = ?', (msg_id,)
+            ).fetchone() is not None
+
+    def get(self, msg_id):
+        """Returns the cached message, or None."""
+        return self.get_many([msg_id]).get(msg_id)
+
+    def get_many(self, ids):
+        """Look up many messages at once.
+
+        Messages whose labels have been invalidated come back without a
+        'labelIds' key, so the caller knows to refresh them.
+
+        Returns:
+            dict[str, dict]: Cached messages by ID; misses are absent.
+        """
+        found = {}
+        with self._lock:
+            for chunk in _chunks(list(ids)):
+                marks = ','.join('?' * len(chunk))
+                rows = self._conn.execute(
+                    'SELECT b.id, b.data, l.label_ids FROM bodies b'
+                    ' LEFT JOIN labels l ON l.id = b.id'
+                    ' WHERE b.id IN (%s)' % marks, chunk)
+                for msg_id, data, label_ids in rows:
+                    msg = json.loads(zlib.decompress(data).decode())
+                    if label_ids is not None:
+                        msg['labelIds'] = json.loads(label_ids)
+                    found[msg_id] = msg
+            with self._conn:
+                self._conn.executemany(
+                    'UPDATE bodies SET accessed = ? WHERE id = ?',
+                    [(time.time(), i) for i in found])
+        return found
+
+    def put(self, msg):
+        self.put_many([msg])
+
+    def put_many(self, messages):
+        """Store full-format messages, then evict down to :attr:`max_bytes`."""
+        bodies, labels = [], []
+        now = time.time()
+        for msg in messages:
+            body = {k: v for k, v in msg.items() if k != 'labelIds'}
+            data = zlib.compress(json.dumps(body).encode())
+            bodies.append((msg['id'], data, len(data), now))
+            labels.append((msg['id'], json.dumps(msg.get('labelIds', []))))
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO bodies VALUES (?, ?, ?, ?)', bodies)
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO labels VALUES (?, ?)', labels)
+            self._evict()
+
+    def put_labels(self, label_ids):
+        """Refresh label metadata.
+
+        Args:
+            label_ids (dict[str, List[str]]): Label IDs by message ID.
+        """
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO labels VALUES (?, ?)',
+                [(i, json.dumps(l)) for i, l in label_ids.items()])
+
+    def invalidate_labels(self, ids=None):
+        """Forget label metadata, keeping bodies.
+
+        Args:
+            ids (Iterable[str]): Messages to invalidate; None for all.
+        """
+        with self._lock, self._conn:
+            if ids is None:
+                self._conn.execute('DELETE FROM labels')
+                return
+            for chunk in _chunks(list(ids)):
+                self._conn.execute(
+                    'DELETE FROM labels WHERE id IN (%s)' %
+                    ','.join('?' * len(chunk)), chunk)
+
+    def size(self):
+        """Returns the compressed size of all cached bodies, in bytes."""
+        with self._lock:
+            return self._size()
+
+    def _size(self):
+        return self._conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM bodies').fetchone()[0]
+
+    def _evict(self):
+        """Drop least recently used bodies until under :attr:`max_bytes`."""
+        excess = self._size() - self.max_bytes
+        if excess <= 0:
+            return
+        doomed = []
+        rows = self._conn.execute(
+            'SELECT id, size FROM bodies ORDER BY accessed')
+        for msg_id, size in rows:
+            if excess <= 0:
+                break
+            doomed.append((msg_id,))
+            excess -= size
+        self._conn.executemany('DELETE FROM bodies WHERE id = ?', doomed)
+        self._conn.executemany('DELETE FROM labels WHERE id = ?', doomed)
+
+    def close(self):
+        self._conn.close()
+
+
+def _chunks(seq, n=500):
+    """Split `seq` to stay under SQLite's limit on bound parameters."""
+    for i in range(0, len(seq), n):
+        yield seq[i:i + n]
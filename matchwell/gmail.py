@@ -6,10 +6,19 @@ Tools for common operations involving Gmail's API.
 import argparse
 import base64
 import email
+import functools
+import itertools
 import json
+import multiprocessing
 import os
+import random
+import re
+import threading
 import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
+from html import unescape
 
 import httplib2
 import numpy as np
@@ -19,9 +28,160 @@ from apiclient import discovery, errors
 from bs4 import BeautifulSoup
 from oauth2client import client, tools
 
-from matchwell import util
+from matchwell import tree, util
 from matchwell.source import Sourcerer
 
+#: MIME types text is extracted from, most preferred first.
+TEXT_MIMETYPES = ('text/plain', 'text/html')
+_CHARSET = re.compile(r'charset\s*=\s*"?([^";\s]+)', re.IGNORECASE)
+#: HTTP statuses which signal a transient failure worth retrying.
+RETRY_STATUSES = {429, 500, 503}
+#: 403 reasons Gmail uses for quota exhaustion, as opposed to a real denial.
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+#: Seconds a mailbox's label listing is trusted before it's fetched again.
+LABEL_TTL = 300.
+
+
+class Backoff:
+    """Adaptive delay shared between concurrently executing batches.
+
+    Every throttled batch doubles the delay, up to ``maximum``; every clean
+    batch halves it again, so the request rate settles just under quota.
+    """
+
+    def __init__(self, initial=0.5, maximum=64.):
+        self.initial = initial
+        self.maximum = maximum
+        self.delay = 0.
+        self._lock = threading.Lock()
+
+    def throttled(self):
+        with self._lock:
+            self.delay = min(max(self.delay * 2, self.initial), self.maximum)
+
+    def succeeded(self):
+        with self._lock:
+            self.delay = self.delay / 2 if self.delay > self.initial else 0.
+
+    def wait(self):
+        """Sleep for the current delay, with jitter to spread out retries."""
+        delay = self.delay
+        if delay:
+            time.sleep(random.uniform(delay / 2, delay))
+
+
+def is_retryable(exc):
+    """Returns True if the error is a rate limit or transient server error."""
+    if not isinstance(exc, errors.HttpError):
+        return False
+    status = exc.resp.status
+    if status in RETRY_STATUSES:
+        return True
+    if status == 403:
+        try:
+            content = json.loads(exc.content.decode())
+            reason = content['error']['errors'][0]['reason']
+        except (AttributeError, ValueError, KeyError, IndexError, TypeError):
+            return False
+        return reason in RATE_LIMIT_REASONS
+    return False
+
+
+class LabelRegistry:
+    """A mailbox's labels, cached for :attr:`ttl` seconds.
+
+    One registry is shared by every :class:`Gmail` for the same account in
+    the process; see :meth:`shared`. Refreshing applies the new listing as a
+    diff, so the ID and name maps are updated in place and stay consistent
+    with one another, and anyone holding them sees the change.
+
+    Attributes:
+        labels (dict[str, dict]): Label resources by ID.
+        names (dict[str, str]): Label name by ID.
+        ids (dict[str, str]): Label ID by name.
+    """
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, ttl=LABEL_TTL):
+        self.ttl = ttl
+        self.labels = {}
+        self.names = {}
+        self.ids = {}
+        self.fetched = None
+        self._lock = threading.RLock()
+
+    @classmethod
+    def shared(cls, key, ttl=LABEL_TTL):
+        """Returns the process-wide registry for `key`, creating it once."""
+        with cls._shared_lock:
+            registry = cls._shared.get(key)
+            if registry is None:
+                registry = cls._shared[key] = cls(ttl)
+            return registry
+
+    def stale(self):
+        return self.fetched is None or \
+            time.monotonic() - self.fetched > self.ttl
+
+    def fresh(self, service, user):
+        """Refresh if stale, letting only one thread do the listing."""
+        if self.stale():
+            with self._lock:
+                if self.stale():
+                    self.refresh(service, user)
+        return self
+
+    def refresh(self, service, user):
+        """List the mailbox's labels and apply the difference.
+
+        Returns:
+            Set[str]: IDs of labels which were added, renamed or removed.
+        """
+        response = service.users().labels().list(userId=user).execute()
+        return self.update(response.get('labels', []))
+
+    def update(self, labels):
+        """Bring the maps in line with a full listing of `labels`."""
+        listed = {label['id']: label for label in labels}
+        with self._lock:
+            changed = set()
+            for label_id in self.labels.keys() - listed.keys():
+                self._remove(label_id)
+                changed.add(label_id)
+            for label_id, label in listed.items():
+                if self.names.get(label_id) != label['name']:
+                    changed.add(label_id)
+                self.add(label)
+            self.fetched = time.monotonic()
+            return changed
+
+    def add(self, label):
+        """Record a label, e.g. one just created."""
+        with self._lock:
+            old = self.names.get(label['id'])
+            if old is not None and self.ids.get(old) == label['id']:
+                del self.ids[old]  # Renamed
+            self.labels[label['id']] = label
+            self.names[label['id']] = label['name']
+            self.ids[label['name']] = label['id']
+
+    def _remove(self, label_id):
+        self.labels.pop(label_id)
+        name = self.names.pop(label_id)
+        if self.ids.get(name) == label_id:
+            del self.ids[name]
+
+    def find(self, name):
+        """Returns the label resource called `name`, or None."""
+        with self._lock:
+            label_id = self.ids.get(name)
+            return None if label_id is None else self.labels[label_id]
+
+    def invalidate(self):
+        """Force the next lookup to list labels again."""
+        self.fetched = None
+
 
 class Gmail:
     """Gmail encapsulates talking to the Gmail API."""
@@ -36,29 +196,68 @@ class Gmail:
     def __init__(self,
                  user_id='me',
                  credentials='gmail-python.json',
-                 service=None):
+                 service=None,
+                 batch_size=50,
+                 max_workers=4,
+                 cache=None,
+                 label_registry=None):
         """
         Args:
             service: Google API service instance.
+            cache (:class:`matchwell.cache.MessageCache`): Local store to
+                serve full-format messages from before hitting the API.
+            label_registry (LabelRegistry): Where labels are cached. By
+                default, clients that connect themselves share a registry
+                per credentials and user, while one handed a `service`,
+                whose mailbox can't be told apart, gets its own.
+            batch_size (int): Messages per batch HTTP request.
+            max_workers (int): Batch requests kept in flight at once. A
+                service handed in brings its own, single connection, so
+                requests through it are made one at a time regardless.
         """
         self.credentials = credentials
         self.user = user_id
         self.service = service
-        # Properties
-        self._labels = None
-        self._label_names = None
-        self._label_ids = None
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.cache = cache
+        self.backoff = Backoff()
+        self._credentials = None
+        self._local = threading.local()
+        if label_registry is None and service is not None:
+            label_registry = LabelRegistry()
+        elif label_registry is None:
+            label_registry = LabelRegistry.shared((credentials, user_id))
+        self.label_registry = label_registry
 
     def connect(self):
         """Creates a Gmail API service object."""
         flags = argparse.ArgumentParser(parents=[tools.argparser]).parse_args([
             '--noauth_local_webserver'
         ])
-        credentials = self.get_credentials(flags)
-        http = credentials.authorize(httplib2.Http())
-        self.service = discovery.build('gmail', 'v1', http=http)
+        self._credentials = self.get_credentials(flags)
+        self.service = discovery.build('gmail', 'v1', http=self._http())
         return self
 
+    def _http(self):
+        """Return this thread's authorized connection.
+
+        :class:`httplib2.Http` isn't thread-safe, so each thread issuing
+        batches gets a connection of its own. Returns None when the service
+        was handed to us, in which case the service's own connection is used.
+        """
+        if self._credentials is None:
+            return None
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = self._credentials.authorize(httplib2.Http())
+            self._local.http = http
+        return http
+
+    def _concurrency(self, n):
+        """Caps `n` threads to one while sharing the service's connection."""
+        return n if self._credentials is not None else 1
+
     def get_credentials(self, flags=None):
         """Gets valid user credentials from storage.
 
@@ -87,36 +286,42 @@ class Gmail:
             print('Storing credentials to ' + credential_path)
         return credentials
 
+    @property
+    def registry(self):
+        """The :class:`LabelRegistry`, refreshed if it's out of date."""
+        return self.label_registry.fresh(self.service, self.user)
+
     @property
     def labels(self):
-        """Build a ID=>Name & Name=>ID mapping for labels"""
-        if not self._labels:
-            try:
-                response = self.service.users().labels().list(
-                        userId=self.user
-                        ).execute()
-                self._labels = response['labels']
-            except errors.HttpError:
-                raise
-        return self._labels
+        """List of label resources."""
+        return list(self.registry.labels.values())
 
     @property
     def label_names(self):
-        if self._label_names:
-            self._label_names = {lbl['name']: lbl['id'] for lbl in
-                                 self.labels}
-        return self._label_names
+        """Label ID by name, kept current in place."""
+        return self.registry.ids
 
     @property
     def label_ids(self):
-        if not self._label_ids:
-            self._label_ids = {lbl['id']: lbl['name'] for lbl in self.labels}
-        return self._label_ids
+        """Label name by ID, kept current in place."""
+        return self.registry.names
+
+    def refresh_labels(self):
+        """List labels again now, regardless of the registry's TTL.
+
+        Returns:
+            Set[str]: IDs of labels which were added, renamed or removed.
+        """
+        return self.label_registry.refresh(self.service, self.user)
 
     def create_label(self, name):
         """Create or retrieve label, if already exists."""
+        registry = self.registry
+        label = registry.find(name)
+        if label is not None:
+            return label
         try:
-            return self.service.users().labels().create(
+            label = self.service.users().labels().create(
                 userId=self.user,
                 body={
                     'messageListVisibility': 'hide',
@@ -124,19 +329,19 @@ class Gmail:
                     'name': name,
                 }).execute()
         except errors.HttpError as e:
-            if e.resp.status == 409:  # Something other than label exists
-                all_labels = self.service.users().labels().list(
-                    userId=self.user
-                ).execute()
-                print("retrieved %d labels" % len(all_labels['labels']))
-                return next(l for l in all_labels['labels']
-                            if l['name'] == name)
+            if e.resp.status == 409:  # Created since we last listed labels
+                registry.refresh(self.service, self.user)
+                label = registry.find(name)
+                if label is not None:
+                    return label
             raise
+        registry.add(label)
+        return label
 
     @property
     def label_tree(self):
         label_names = set([l['name'] for l in self.labels])
-        return util.build_prefix_tree(label_names)
+        return tree.build_prefix_tree(label_names)
 
     def print_label_tree(self):
         """Print a JSON representation of your label hierarchy."""
@@ -164,7 +369,7 @@ class Gmail:
         else:
             print("Retrieving messages with *any* label")
 
-        start = time.clock()
+        start = time.perf_counter()
         try:
             response = self.service.users().messages().list(
                     **list_kwargs
@@ -173,18 +378,20 @@ class Gmail:
             count = 0
             if 'messages' in response:
                 print("Retrieved %d message IDs in %.3f seconds" %
-                      (response['resultSizeEstimate'], time.clock() - start))
+                      (response['resultSizeEstimate'],
+                       time.perf_counter() - start))
                 yield response['messages']
                 count += response['resultSizeEstimate']
 
             while 'nextPageToken' in response:
-                now = time.clock()
+                now = time.perf_counter()
                 list_kwargs['pageToken'] = response['nextPageToken']
                 response = self.service.users().messages().list(
                         **list_kwargs
                     ).execute()
                 print("Retrieved another %d message IDs in %.3f seconds" %
-                      (response['resultSizeEstimate'], time.clock() - now))
+                      (response['resultSizeEstimate'],
+                       time.perf_counter() - now))
                 yield response['messages']
                 count += response['resultSizeEstimate']
                 if limit is not None and count >= limit:
@@ -196,7 +403,37 @@ class Gmail:
             raise
 
         print("Retrieved %d total message IDs in %.3f seconds" %
-              (count, time.clock() - start))
+              (count, time.perf_counter() - start))
+
+    def get_profile(self):
+        """Retrieve the mailbox profile, including its current historyId."""
+        return self.service.users().getProfile(userId=self.user).execute()
+
+    def list_history(self, start_history_id, history_types=None):
+        """Retrieve mailbox changes made after a history ID.
+
+        https://developers.google.com/gmail/api/v1/reference/users/history/list
+
+        Args:
+            start_history_id (str): historyId to list changes after.
+            history_types (List[str]): Restrict to these change types, e.g.
+                'messageAdded' or 'labelRemoved'.
+        Yields:
+            dict: Each page of the response, holding 'history' records and
+            the mailbox's current 'historyId'.
+        """
+        list_kwargs = {'userId': self.user,
+                       'startHistoryId': start_history_id}
+        if history_types is not None:
+            list_kwargs['historyTypes'] = history_types
+        while True:
+            response = self.service.users().history().list(
+                    **list_kwargs
+                ).execute()
+            yield response
+            if 'nextPageToken' not in response:
+                break
+            list_kwargs['pageToken'] = response['nextPageToken']
 
     def get_email(self, msg_id, format='full', user_id='me'):
         """Download a Users.Message resource, i.e. Gmail's format for email.
@@ -206,54 +443,192 @@ class Gmail:
         Returns:
             https://developers.google.com/gmail/api/v1/reference/users/messages
         """
+        cached = self.cache is not None and format == 'full'
+        if cached:
+            msg = self.cache.get(msg_id)
+            if msg is not None and 'labelIds' in msg:
+                return msg
         msg = self.service.users().messages().get(
             userId=user_id, id=msg_id, format=format
         ).execute()
+        if cached:
+            self.cache.put(msg)
         # Convert raw emails into Python objects
         if format == 'raw':
             msg_str = base64.urlsafe_b64decode(msg['raw']).decode()
             return email.message_from_string(msg_str)
         return msg
 
-    def download_emails(self, msgs):
+    def download_emails(self, msgs, format='full', max_retries=5):
         """Download the raw emails.
 
+        Messages are split into batches of :attr:`batch_size`, with up to
+        :attr:`max_workers` batches in flight at once. Requests rejected by
+        rate limiting are retried with adaptive backoff instead of dropped.
+
         Args:
-            msgs: List of results from list_messages; dicts containing 'msgId'
+            msgs: List of results from list_messages; dicts containing 'id'
                 and 'threadId'.
+            format (str): Gmail message format to request.
+            max_retries (int): Rounds of retries for throttled requests.
         Returns:
-            List[:class:`users.messages.Resource`]: List of full-format emails.
+            List[:class:`users.messages.Resource`]: List of full-format emails,
+            in the order they were requested.
         """
-        if len(msgs) > 1000:
-            print("Can only batch <=1000 downloads at a time")
-            return
-        emails = []
+        ids = [msg['id'] for msg in msgs]
+        if self.cache is None or format != 'full':
+            emails = self._download(ids, format, max_retries)
+        else:
+            emails = self._download_cached(ids, max_retries)
+        return [emails[i] for i in ids if i in emails]
+
+    def _download_cached(self, ids, max_retries):
+        """Serve what we can from :attr:`cache`, downloading the rest.
+
+        Cached messages whose labels were invalidated only have their label
+        IDs refreshed, via the much smaller 'minimal' format.
+        """
+        emails = self.cache.get_many(ids)
+        hits = len(emails)
+        missing = [i for i in ids if i not in emails]
+        downloaded = self._download(missing, 'full', max_retries)
+        self.cache.put_many(downloaded.values())
+        stale = [i for i, msg in emails.items() if 'labelIds' not in msg]
+        if stale:
+            minimal = self._download(stale, 'minimal', max_retries)
+            labels = {i: m.get('labelIds', []) for i, m in minimal.items()}
+            self.cache.put_labels(labels)
+            for i in stale:
+                if i in labels:
+                    emails[i]['labelIds'] = labels[i]
+                else:  # Deleted since it was cached
+                    del emails[i]
+        emails.update(downloaded)
+        print("Served %d of %d emails from cache" % (hits, len(ids)))
+        return emails
+
+    def _download(self, ids, format='full', max_retries=5):
+        """Download messages in concurrent batches, retrying throttling.
+
+        Returns:
+            dict[str, :class:`users.messages.Resource`]: Emails by ID.
+        """
+        emails = {}
+        pending = ids
+        for attempt in range(max_retries + 1):
+            batches = [pending[i:i + self.batch_size]
+                       for i in range(0, len(pending), self.batch_size)]
+            workers = self._concurrency(self.max_workers)
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                failed = list(itertools.chain.from_iterable(pool.map(
+                    lambda b: self._execute_batch(b, emails, format),
+                    batches)))
+            if not failed:
+                break
+            if attempt == max_retries:
+                print("Gave up on %d throttled emails" % len(failed))
+                break
+            print("Throttled on %d emails; retrying in ~%.1f seconds" %
+                  (len(failed), self.backoff.delay))
+            pending = failed
+        print("Downloaded %d emails" % len(emails))
+        return emails
+
+    def _execute_batch(self, ids, results, format='full'):
+        """Fetch one batch of messages into `results`.
+
+        Returns:
+            List[str]: IDs which failed retryably, e.g. due to rate limiting.
+        """
+        failed = []
 
         def callback(request_id, response, exception):
-            if exception is not None:
-                pass
-            else:
-                emails.append(response)
+            if exception is None:
+                results[request_id] = response
+            elif is_retryable(exception):
+                failed.append(request_id)
+            # Anything else, e.g. a message deleted since listing, is dropped
 
+        self.backoff.wait()
         batch = self.service.new_batch_http_request(callback=callback)
-        for msg in msgs:
+        for msg_id in ids:
             batch.add(
                 self.service.users().messages().get(
-                    userId='me', id=msg['id'], format='full'
-                )
+                    userId=self.user, id=msg_id, format=format
+                ),
+                request_id=msg_id
             )
-        batch.execute()
-        print("Downloaded %d emails" % len(emails))
-        return emails
+        try:
+            batch.execute(http=self._http())
+        except errors.HttpError as e:
+            if not is_retryable(e):
+                raise
+            failed = [i for i in ids if i not in results]
+        if failed:
+            self.backoff.throttled()
+        else:
+            self.backoff.succeeded()
+        return failed
+
+    def download_pages(self, pages, prefetch=2):
+        """Download pages of messages while later pages are still listed.
+
+        Args:
+            pages: Iterable of message ID lists, e.g. from
+                :meth:`list_messages`.
+            prefetch (int): Pages downloading ahead of the consumer. Without
+                a connection of our own, pages are downloaded in turn, since
+                listing would otherwise share it with the downloads.
+        Yields:
+            List[:class:`users.messages.Resource`], one list per page, in
+            page order.
+        """
+        if self._concurrency(prefetch) < prefetch:
+            for page in pages:
+                yield self.download_emails(page)
+            return
+        with ThreadPoolExecutor(max_workers=prefetch) as pool:
+            futures = deque()
+            for page in pages:
+                futures.append(pool.submit(self.download_emails, page))
+                if len(futures) > prefetch:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
 
 
 class GmailSource(Sourcerer):
     name = 'gmail'
+    #: Label names which never make it into the frame.
+    blacklist = frozenset(['CHAT', 'SMS'])
 
-    def __init__(self, gmail=None):
+    def __init__(self, gmail=None, compact=False, html_engine='fast',
+                 workers=1, task_size=100):
+        """
+        Args:
+            gmail (Gmail): API wrapper to use; connects one if omitted.
+            compact (bool): Leave message resources out of the 'raw' column,
+                keeping only the ``id`` as a handle for :meth:`resolve_raw`.
+                Pair with a :class:`matchwell.cache.MessageCache` so that
+                resolving doesn't go back to the API.
+            html_engine (str): How to strip HTML-only emails; see
+                :func:`html_to_text`.
+            workers (int): Processes extracting text; None for one per CPU.
+                The pool is started once and reused by every pull; see
+                :meth:`close`.
+            task_size (int): Messages handed to a worker at a time.
+        """
         self._gmail = gmail
+        self.compact = compact
+        self.html_engine = html_engine
+        self.workers = workers
+        self.task_size = task_size
+        self._pool = None
         self.raw = None
         self.transformed = None
+        #: Mailbox historyId as of the last pull, used by :meth:`sync`; see
+        #: :meth:`save_state` to carry it over to another process.
+        self.history_id = None
 
     @property
     def gmail(self):
@@ -261,53 +636,210 @@ class GmailSource(Sourcerer):
             self._gmail = Gmail().connect()
         return self._gmail
 
+    @property
+    def pool(self):
+        """Process pool extracting text, or None for a single worker."""
+        if self._pool is None and (self.workers or os.cpu_count()) > 1:
+            self._pool = process_pool(self.workers)
+        return self._pool
+
+    def close(self):
+        """Shut down the text extraction processes."""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     def pull(self, newer_than=None, **kwargs):
         """Retrieve emails."""
-        if newer_than is not None:
-            print('Retrieving messages newer than %s' % newer_than)
-            query = 'after:' + newer_than
-        else:
-            query = None
+        return self._transform(self._extract(self._query(newer_than)))
+
+    def pull_iter(self, *, newer_than=None, chunk_size=1000, **kwargs):
+        """Retrieve emails as a stream of frames.
+
+        Each chunk is transformed as soon as enough pages have arrived, and
+        neither raw nor transformed messages are kept afterwards, so memory
+        stays bounded by `chunk_size` rather than the mailbox.
+
+        Yields:
+            :class:`pandas.DataFrame` of at most `chunk_size` rows.
+        """
+        buffered = []
+        for emails in self._download_pages(self._query(newer_than)):
+            buffered.extend(emails)
+            while len(buffered) >= chunk_size:
+                chunk, buffered = buffered[:chunk_size], buffered[chunk_size:]
+                yield self._transform(chunk)
+        if buffered:
+            yield self._transform(buffered)
+
+    def resolve_raw(self, ids):
+        """Fetch the message resources behind rows of a compact frame.
+
+        Args:
+            ids (Iterable[str]): Message IDs, e.g. ``df['id']``.
+        Returns:
+            :class:`pandas.Series` of message resources, indexed by ID.
+        """
+        emails = self.gmail.download_emails([{'id': i} for i in ids])
+        return pd.Series(emails, index=[e['id'] for e in emails],
+                         dtype=object)
+
+    def _query(self, newer_than=None):
+        if newer_than is None:
+            return None
+        print('Retrieving messages newer than %s' % newer_than)
+        return 'after:' + newer_than
+
+    def save_state(self, path):
+        """Record :attr:`history_id`, so a later process can :meth:`sync`.
+
+        Save once the pulled frame has been stored, e.g. next to a
+        :class:`matchwell.store.MessageStore`, so that a crash in between
+        re-syncs those changes rather than skipping them.
+
+        Args:
+            path (str): JSON file to write; replaced atomically.
+        """
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'history_id': self.history_id}, f)
+        os.replace(path + '.tmp', path)
 
-        return self._transform(self._extract(query))
+    def load_state(self, path):
+        """Restore :attr:`history_id` from :meth:`save_state`.
+
+        A missing file leaves it as it is, e.g. None on a first run.
+
+        Returns:
+            The source, for chaining.
+        """
+        if os.path.exists(path):
+            with open(path) as f:
+                self.history_id = json.load(f)['history_id']
+        return self
+
+    def sync(self, history_id=None):
+        """Retrieve only the messages changed since the last pull or sync.
+
+        Uses Gmail's history records rather than re-listing the mailbox, so
+        the cost follows the number of changes. Falls back to a full pull if
+        Gmail no longer holds history that far back.
+
+        Args:
+            history_id (str): historyId to sync from; defaults to the one
+                recorded by the last :meth:`pull` or :meth:`sync`.
+        Returns:
+            A delta :class:`pandas.DataFrame`, with an extra 'change' column
+            of 'added', 'labels' or 'deleted'; see :func:`util.apply_delta`.
+        """
+        start = history_id or self.history_id
+        if start is None:
+            raise ValueError("No historyId to sync from; pull() or "
+                             "load_state() first")
+        try:
+            changes = self._history_changes(start)
+        except errors.HttpError as e:
+            if e.resp.status != 404:
+                raise
+            print("History after %s has expired; pulling everything" % start)
+            df = self.pull()
+            df['change'] = 'added'
+            return df
+
+        if self.gmail.cache is not None:
+            self.gmail.cache.invalidate_labels(
+                [i for i, c in changes.items() if c == 'labels'])
+        fetch = [{'id': i} for i, c in changes.items() if c != 'deleted']
+        df = self._transform(self.gmail.download_emails(fetch))
+        df['change'] = df['id'].map(changes)
+        deleted = [i for i, c in changes.items() if c == 'deleted']
+        gone = pd.DataFrame({'id': deleted, 'type': self.name,
+                             'change': 'deleted'},
+                            columns=util.new_data_frame().columns.tolist() +
+                            ['change'])
+        return pd.concat([df, gone], ignore_index=True)
+
+    def _history_changes(self, start):
+        """Collapse history records into the latest change per message ID."""
+        changes = {}
+        for page in self.gmail.list_history(start):
+            for record in page.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    changes[added['message']['id']] = 'added'
+                for key in ('labelsAdded', 'labelsRemoved'):
+                    for relabeled in record.get(key, []):
+                        msg_id = relabeled['message']['id']
+                        changes.setdefault(msg_id, 'labels')
+                for deleted in record.get('messagesDeleted', []):
+                    changes[deleted['message']['id']] = 'deleted'
+            self.history_id = page['historyId']
+        return changes
 
     def _extract(self, query):
         messages = []
-        for msgs in self.gmail.list_messages(query=query):
-            messages.extend(self.gmail.download_emails(msgs))
-        self.raw = messages
+        for emails in self._download_pages(query):
+            messages.extend(emails)
+        if not self.compact:
+            self.raw = messages
         return messages
 
+    def _download_pages(self, query):
+        # Record where the mailbox stands before listing, so a later sync
+        # can't miss anything that arrives mid-download.
+        self.history_id = self.gmail.get_profile()['historyId']
+        pages = self.gmail.list_messages(query=query)
+        return self.gmail.download_pages(pages)
+
     def _transform(self, messages):
-        self.transformed = df = pd.DataFrame()
-        df['raw'] = messages
-        df['timestamp'] = df.apply(lambda x: get_datetime(x.raw, True), axis=1)
-        df.set_index('timestamp')
-        df['type'] = self.name
-        df['text'] = df.apply(
-            lambda x: extract_gmail_text(x.raw['payload']), axis=1)
-        # Remove null entries
-        df = df[df['text'].notnull()]
-
-        # TODO Collapse the following two applies into one step
-        # Translate IDs to string names
-        df['labels'] = df['raw'].apply(
-            lambda x: [self.gmail.label_ids[lbl] for lbl
-                       in x.get('labelIds', [])]
-        )
-        # Drop unwanted labels
-        blacklist = ['CHAT', 'SMS']
-        for blk in blacklist:
-            df['labels'] = df['labels'].apply(
-                lambda x: [lbl for lbl in x if lbl != blk])
-        # Message id serves as the unique ID for the message;
-        # could turn into the full URL
-        df['id'] = df.apply(lambda x: x.raw['id'], axis=1)
+        """Build a frame from downloaded messages in a single pass.
+
+        Every field is pulled out of the raw dicts in one loop, and the frame
+        is built from whole columns at once. Text extraction, the costly
+        part, is spread across :attr:`workers` processes.
+        """
+        label_ids = self.gmail.label_ids
+        if any(lbl not in label_ids for msg in messages
+               for lbl in msg.get('labelIds', [])):
+            # Labels made since the last listing; look once, then skip any
+            # still unknown, e.g. deleted while their messages downloaded
+            self.gmail.refresh_labels()
+            label_ids = self.gmail.label_ids
+        blacklist = self.blacklist
+        texts = extract_texts([msg['payload'] for msg in messages],
+                              self.html_engine, self.workers, self.task_size,
+                              pool=self.pool)
+        columns = {'timestamp': [], 'id': [], 'raw': [], 'text': [],
+                   'labels': []}
+        for msg, text in zip(messages, texts):
+            if text is None:  # Remove null entries
+                continue
+            columns['timestamp'].append(msg['internalDate'])
+            # Message id serves as the unique ID for the message;
+            # could turn into the full URL
+            columns['id'].append(msg['id'])
+            columns['raw'].append(None if self.compact else msg)
+            columns['text'].append(text)
+            # Translate IDs to string names, dropping unwanted labels
+            names = (label_ids.get(lbl) for lbl in msg.get('labelIds', []))
+            columns['labels'].append(
+                [n for n in names if n is not None and n not in blacklist])
+        # internalDate is epoch milliseconds
+        columns['timestamp'] = pd.to_datetime(
+            np.array(columns['timestamp'], dtype=np.int64), unit='ms')
+        columns['type'] = self.name
+        df = pd.DataFrame(columns, columns=util.new_data_frame().columns,
+                          index=pd.RangeIndex(len(columns['id'])))
+        self.transformed = df
         return df
 
 
 # Utility functions
-def extract_gmail_text(payload):
+def extract_gmail_text(payload, engine='fast'):
     """Parse the *most likely* source of human-readable text from
     the email.
 
@@ -317,14 +849,104 @@ def extract_gmail_text(payload):
     * text/plain, which is base64 decoded.
     * text/html, which is base64 decoded and then
       parsed for text elements.
+
+    The whole MIME tree is walked once, in document order, skipping
+    attachments. Only the chosen part is decoded, using its declared charset.
+
+    Args:
+        payload (dict): The message's 'payload'.
+        engine (str): HTML engine; see :func:`html_to_text`.
+    Returns:
+        str, or None if the message has no text part.
     """
-    if payload['mimeType'] == 'text/plain':
-        return base64.urlsafe_b64decode(payload['body']['data']).decode()
-    if payload['mimeType'] == 'text/html':
-        return parse_html_email(payload['body']['data'])
-    # Else, recurse
-    for part in payload.get('parts', []):
-        return extract_gmail_text(part)
+    found = {}
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        mimetype = part.get('mimeType')
+        if mimetype in TEXT_MIMETYPES:
+            if (mimetype not in found and not part.get('filename') and
+                    part.get('body', {}).get('data')):
+                found[mimetype] = part
+                if mimetype == TEXT_MIMETYPES[0]:
+                    break  # Can't do better
+        else:
+            stack.extend(reversed(part.get('parts', [])))
+
+    if 'text/plain' in found:
+        part = found['text/plain']
+        return decode_body(part['body']['data'], get_charset(part))
+    if 'text/html' in found:
+        part = found['text/html']
+        return parse_html_email(part['body']['data'], engine,
+                                get_charset(part))
+    return None
+
+
+def decode_body(data, charset='utf-8'):
+    """Decode a base64url message part body into text.
+
+    Unknown charsets fall back to UTF-8, and undecodable bytes are replaced
+    rather than failing the whole message.
+    """
+    raw = base64.urlsafe_b64decode(data)
+    try:
+        return raw.decode(charset, errors='replace')
+    except LookupError:
+        return raw.decode('utf-8', errors='replace')
+
+
+def get_charset(part, default='utf-8'):
+    """Read the charset from a message part's Content-Type header."""
+    for header in part.get('headers', []):
+        if header['name'].lower() == 'content-type':
+            m = _CHARSET.search(header['value'])
+            if m is not None:
+                return m.group(1)
+    return default
+
+
+def process_pool(workers=None):
+    """Returns a process pool that's safe to start from a threaded process.
+
+    Downloads run in threads, and forking while one holds a lock can leave
+    the child deadlocked, so workers come from a forkserver where there is
+    one, else are spawned, rather than forked.
+
+    Args:
+        workers (int): Worker processes; None for one per CPU.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context(
+        'forkserver' if 'forkserver' in methods else 'spawn')
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context)
+
+
+def extract_texts(payloads, engine='fast', workers=1, chunk_size=100,
+                  pool=None):
+    """Run :func:`extract_gmail_text` over many payloads in a process pool.
+
+    Workers only send back the extracted text, never the payloads.
+
+    Args:
+        payloads (List[dict]): Message payloads.
+        engine (str): HTML engine; see :func:`html_to_text`.
+        workers (int): Worker processes; None for one per CPU.
+        chunk_size (int): Payloads sent to a worker at a time.
+        pool (:class:`concurrent.futures.ProcessPoolExecutor`): Pool to use,
+            e.g. from :func:`process_pool`; one is started and shut down
+            for this call if omitted.
+    Returns:
+        List[str]: Text per payload, or None where none was found.
+    """
+    workers = workers or os.cpu_count()
+    if workers == 1 or len(payloads) <= chunk_size:  # Not worth a pool
+        return [extract_gmail_text(p, engine) for p in payloads]
+    extract = functools.partial(extract_gmail_text, engine=engine)
+    if pool is not None:
+        return list(pool.map(extract, payloads, chunksize=chunk_size))
+    with process_pool(workers) as pool:
+        return list(pool.map(extract, payloads, chunksize=chunk_size))
 
 
 def get_datetime(message, numpy=True):
@@ -353,8 +975,37 @@ def extract_by_mimetype(msg, mimetype='text/plain'):
             return part.get_payload(decode=True)
 
 
-def parse_html_email(data):
+def parse_html_email(data, engine='fast', charset='utf-8'):
     """Parse a text/html Email message part."""
-    text = base64.urlsafe_b64decode(data).decode()
-    soup = BeautifulSoup(text, 'html.parser')
-    return soup.get_text()
+    return html_to_text(decode_body(data, charset), engine)
+
+
+#: Elements whose contents are never human-readable text, plus comments.
+#: One left unclosed runs to the end of the document, as browsers treat it,
+#: so every match is found in a single scan however hostile the markup.
+_INVISIBLE_HTML = re.compile(
+    r'<(script|style)\b.*?(?:</\1\s*>|\Z)|<!--.*?(?:-->|\Z)',
+    re.IGNORECASE | re.DOTALL)
+#: Only a '<' opening a tag name, end tag, comment, doctype or processing
+#: instruction starts a tag, so text like '1 < 2' survives. A tag can't
+#: contain another '<', which bounds each attempt at the next one.
+_HTML_TAG = re.compile(r'<[A-Za-z/!?][^<>]*>')
+
+
+def html_to_text(html, engine='fast'):
+    """Strip markup from an HTML document, leaving its text.
+
+    Args:
+        html (str): HTML document.
+        engine (str): 'fast' deletes scripts, styles, comments and tags with
+            regular expressions, never building a document tree. 'bs4' parses
+            the document with BeautifulSoup's html.parser; it's several times
+            slower, but forgiving of markup the fast engine misreads, such as
+            a '>' inside an attribute value.
+    """
+    if engine == 'fast':
+        text = _INVISIBLE_HTML.sub('', html)
+        return unescape(_HTML_TAG.sub('', text))
+    if engine == 'bs4':
+        return BeautifulSoup(html, 'html.parser').get_text()
+    raise ValueError("Unknown HTML engine %r" % engine)
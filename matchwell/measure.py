@@ -1,7 +1,20 @@
+import time
+
 import matplotlib.pyplot as plt
 import numpy as np
 from scipy.special import expit
-from sklearn import metrics, cross_validation
+from sklearn import metrics
+from sklearn.base import clone, is_classifier
+from sklearn.model_selection import KFold, check_cv
+from sklearn.pipeline import Pipeline
+
+from matchwell import tree
+from matchwell.models import HierarchicalClassifier, take_rows
+
+try:
+    from joblib import Parallel, delayed
+except ImportError:  # Vendored by scikit-learn before 0.21
+    from sklearn.externals.joblib import Parallel, delayed
 
 
 def report(y, pred, labels=()):
@@ -12,20 +25,130 @@ def report(y, pred, labels=()):
     print("Confusion Matrix\n", metrics.confusion_matrix(y, pred))
 
 
-def cv_scores(clf, X, y, cv=5, plot=False):
-    scores = cross_validation.cross_val_score(clf, X, y, cv)
-    print("Scores:\n" + '\n'.join((str(x) for x in scores)))
+def cv_scores(clf, X, y, cv=5, plot=False, n_jobs=-1, backend=None):
+    """Cross-validate a model, evaluating its folds in parallel.
+
+    A :class:`sklearn.pipeline.Pipeline` has its feature steps fit on each
+    fold's training split once, and the resulting matrices handed to its
+    final step. A :class:`matchwell.models.HierarchicalClassifier` is
+    scored with :func:`hierarchical_scores` instead of accuracy.
+
+    Args:
+        clf: Model to evaluate; it's cloned, never fit itself.
+        X (pandas.Series): Raw text.
+        y: Target per document; label lists for a HierarchicalClassifier.
+        cv: Number of folds, or a scikit-learn splitter such as
+            :class:`sklearn.model_selection.KFold`.
+        plot (bool): Plot each score across the folds.
+        n_jobs (int): Folds evaluated at once; -1 for one per CPU.
+        backend (str): joblib backend to evaluate with.
+    Returns:
+        dict[str, numpy.ndarray]: Per-fold values of each score, along with
+        'fit_time' and 'score_time' in seconds; Pipelines also report
+        'vectorize_time', which is included in 'fit_time'.
+    """
+    y = _as_rows(y)
+    if isinstance(clf, HierarchicalClassifier):
+        if isinstance(cv, int):
+            folds = KFold(n_splits=cv, shuffle=True, random_state=42)
+        else:
+            folds = check_cv(cv)
+        stratify = None
+    else:
+        folds = check_cv(cv, y, classifier=is_classifier(clf))
+        stratify = y
+    results = Parallel(n_jobs=n_jobs, backend=backend)(
+        delayed(_cv_fold)(clone(clf), X, y, train, test)
+        for train, test in folds.split(np.zeros(len(y)), stratify))
+    scores = {name: np.array([r[name] for r in results])
+              for name in results[0]}
+    print("Scores:\n" + '\n'.join(
+        "{}: {:.3f} (+/- {:.3f})".format(name, s.mean(), s.std())
+        for name, s in sorted(scores.items())))
     if plot:
-        for i, name in enumerate(scores):
-            plt.subplot(len(scores), 1, i + 1)
-            plt.bar(np.arange(1, 6), scores[name], color="#348ABD")
+        names = [n for n in sorted(scores) if not n.endswith('_time')]
+        for i, name in enumerate(names):
+            plt.subplot(len(names), 1, i + 1)
+            n_folds = len(scores[name])
+            plt.bar(np.arange(1, n_folds + 1), scores[name], color="#348ABD")
             # Plot the mean as a horizontal line
             plt.axhline(y=scores[name].mean(), color='r', linestyle='-')
-            plt.xlim(0, 7)
+            plt.xlim(0, n_folds + 1)
             plt.ylim(.0, 1.)
+            plt.ylabel(name)
     return scores
 
 
+def _as_rows(y):
+    """Make `y` selectable by row positions, without stacking label lists.
+
+    Lists become 1-d object arrays, filled item by item, so ragged (or
+    equally long) label lists aren't turned into a 2-d array.
+    """
+    if not isinstance(y, (list, tuple)):
+        return y  # Series, arrays and label columns select rows already
+    rows = np.empty(len(y), dtype=object)
+    for i, item in enumerate(y):
+        rows[i] = item
+    return rows
+
+
+def _cv_fold(clf, X, y, train, test):
+    """Fit on one fold's training rows and score its test rows."""
+    X_train, X_test = take_rows(X, train), take_rows(X, test)
+    result = {}
+    start = time.time()
+    if isinstance(clf, Pipeline):
+        # Vectorize the training split once, and reuse the fitted steps
+        features = Pipeline(clf.steps[:-1])
+        X_train = features.fit_transform(X_train)
+        X_test = features.transform(X_test)
+        result['vectorize_time'] = time.time() - start
+        clf = clf.steps[-1][1]
+    y_train, y_test = take_rows(y, train), take_rows(y, test)
+    clf.fit(X_train, y_train)
+    result['fit_time'] = time.time() - start
+
+    start = time.time()
+    if isinstance(clf, HierarchicalClassifier):
+        result.update(hierarchical_scores(y_test, clf.predict(X_test),
+                                          clf.threshold))
+    else:
+        result['score'] = clf.score(X_test, y_test)
+    result['score_time'] = time.time() - start
+    return result
+
+
+def hierarchical_scores(y_true, predictions, threshold=.5):
+    """Hierarchical precision, recall and F1.
+
+    True and predicted labels are both extended with their ancestors before
+    being compared, so a prediction in the right branch but at the wrong
+    depth earns partial credit.
+
+    Args:
+        y_true (Iterable[List[str]]): True labels per document.
+        predictions (List[dict[str, float]]): Output of
+            :meth:`HierarchicalClassifier.predict`.
+        threshold (float): Probability at which a node counts as predicted.
+    Returns:
+        dict with 'precision', 'recall' and 'f1'.
+    """
+    overlap = n_predicted = n_true = 0
+    for labels, probs in zip(y_true, predictions):
+        true = tree.ancestry(labels)
+        predicted = tree.ancestry(n for n, p in probs.items()
+                                  if p >= threshold)
+        overlap += len(true & predicted)
+        n_predicted += len(predicted)
+        n_true += len(true)
+    precision = overlap / n_predicted if n_predicted else 0.
+    recall = overlap / n_true if n_true else 0.
+    f1 = (2 * precision * recall / (precision + recall)
+          if precision + recall else 0.)
+    return {'precision': precision, 'recall': recall, 'f1': f1}
+
+
 def show_confidence(clf, X, plot=False):
     """Analyze prediction confidence."""
     confs = clf.decision_function(X)
@@ -1,74 +1,354 @@
+import json
+import os
 import pickle
 
 import networkx as nx
 import matplotlib.pyplot as plt
-from sklearn.feature_extraction.text import (CountVectorizer, TfidfTransformer)
+import numpy as np
+import scipy.sparse as sp
+from scipy.special import expit, logit
+from sklearn.feature_extraction.text import (
+    CountVectorizer, HashingVectorizer, TfidfTransformer)
 from sklearn.pipeline import Pipeline
-from sklearn.grid_search import GridSearchCV
-from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.base import (
+    BaseEstimator, ClassifierMixin, TransformerMixin, clone, is_classifier)
 from sklearn.linear_model import SGDClassifier
-from sklearn.preprocessing import MultiLabelBinarizer
+from sklearn.metrics import get_scorer
+from sklearn.model_selection import (
+    GridSearchCV, KFold, ParameterGrid, StratifiedKFold)
+from sklearn.preprocessing import normalize
 
 from matchwell import tree, util
 
+try:
+    from joblib import Parallel, delayed
+except ImportError:  # Vendored by scikit-learn before 0.21
+    from sklearn.externals.joblib import Parallel, delayed
+
 
 class HierarchicalClassifier(BaseEstimator, ClassifierMixin):
 
-    def __init__(self):
-        pass
+    def __init__(self, alpha=1e-3, n_jobs=1, backend='threading',
+                 threshold=.5, beam_width=None, hashing=False,
+                 n_features=2 ** 18):
+        """
+        Args:
+            alpha (float): Regularization strength of every node's model.
+            n_jobs (int): Node models trained at once; -1 for one per CPU.
+            backend (str): joblib backend to train with. 'threading' shares
+                `X` between workers without copying it.
+            threshold (float): Probability a node needs before its children
+                are considered during prediction.
+            beam_width (int): Most nodes per level, per document, whose
+                children are considered; None for no limit.
+            hashing (bool): Hash words into features instead of learning a
+                vocabulary; see :func:`build_features`.
+            n_features (int): Number of hashed features.
+        """
+        self.alpha = alpha
+        self.n_jobs = n_jobs
+        self.backend = backend
+        self.threshold = threshold
+        self.beam_width = beam_width
+        self.hashing = hashing
+        self.n_features = n_features
 
     def fit(self, X, y, verbose=False):
         """Train the model.
 
         Setup
             1. Build Tree from labels in `y`
-            2. Build & train models for each parent node
-                a. Filter `y` to only contain child labels of parent
-                b. Convert to a binary array of classes
+            2. Build & train a binary model for each node below the root,
+               deciding whether a document belongs under that node.
+               A node's model is only trained on documents under its
+               parent, so each level of the tree costs one pass over the
+               corpus, rather than each node.
 
+        Text is vectorized once, up front, and each node model is handed
+        rows of the resulting sparse matrix.
 
-        Training:
-            for p in parents:
-                y_scoped = get_classes_by_level(T, parent, y)
-                p.fit(X, y_scoped)
+        Nodes are independent of one another, so they're trained in
+        parallel across :attr:`n_jobs` workers.
 
         Args:
             X (pandas.Series): Raw text.
-            y (List[str]): Associated labels for each training value.
+            y (List[str]): Associated labels for each training value, or
+                a :class:`matchwell.util.LabelColumn` of them.
         """
+        self._loaded_from = None  # Fitted afresh, so updatable again
         # Build a set of unique values
-        self._all_classes = tree.collapse_unique(y)
+        self._all_classes = label_names(y)
         if verbose:
             print("Classes: ", self._all_classes)
         # Create an ancestral tree of all labels
-        self._tree = tree.from_labels(self._all_classes)
+        self._tree = tree.ArrayTree.from_labels(self._all_classes)
         if verbose:  # Save a PNG of the tree
-            nx.draw(self._tree, pos=nx.spring_layout(self._tree))
+            G = self._tree.to_networkx()
+            nx.draw(G, pos=nx.spring_layout(G))
             plt.tight_layout()
             plt.savefig("hc_tree.png", format="PNG")
-        # For each level of the tree
-        for n in self._tree.nodes:
-            print('Training', n)
-            # Create a model
-            clf = SGDClassifier(
-                loss='hinge', penalty='l2', alpha=1e-3, n_iter=5,
-                random_state=42)
-            # Filter target array to only contain child labels for this node.
-            y_scoped = y.apply(
-                lambda x: util.intersection(x, self._tree.successors(n)))
-            self._tree[n]['classes'] = util.collapse_unique(y_scoped)
-            # Convert to binary array
-            y_binary = MultiLabelBinarizer().fit_transform(y_scoped)
-            self._tree[n]['clf'] = clf.fit(X, y_binary)
-            # RESUME
+        # Tokenize once; every node model trains on rows of the same matrix
+        self._features = build_features(self.hashing, self.n_features)
+        X = self._vectorize(X, learn=True)
+        self._n_features = X.shape[1]
+        self._weights = self._intercepts = None
+        # Each node only learns to tell apart documents under its parent
+        index = label_index(y)
+        every_row = np.arange(len(y))
+        names, parent = self._tree.names, self._tree.parent
+        jobs = []
+        for i in range(1, len(self._tree)):
+            rows = every_row if parent[i] == 0 else index[names[parent[i]]]
+            jobs.append(delayed(_fit_node)(
+                self._node_model(), X, np.isin(rows, index[names[i]]), rows))
+        fitted = Parallel(n_jobs=self.n_jobs, backend=self.backend,
+                          verbose=10 if verbose else 0)(jobs)
+        # Node models, priors and example counts, by node ID
+        self._models = [None] + [clf for clf, _, _ in fitted]
+        self._priors = np.array([1.] + [prior for _, prior, _ in fitted])
+        self._seen = np.array([len(y)] + [seen for _, _, seen in fitted])
+        return self
+
+    def partial_fit(self, X, y, verbose=False):
+        """Update the model with a new batch of documents.
+
+        Only nodes whose parent appears in the batch are touched, and their
+        models take a few more SGD steps rather than being retrained.
+        Labels not seen before grow the tree with new nodes. Words outside
+        the vocabulary learned by the first :meth:`fit` are ignored.
+
+        Args:
+            X (pandas.Series): Raw text.
+            y (List[str]): Associated labels for each training value, or
+                a :class:`matchwell.util.LabelColumn` of them.
+        """
+        if not hasattr(self, '_tree'):
+            return self.fit(X, y, verbose=verbose)
+        if getattr(self, '_loaded_from', None) is not None:
+            raise ValueError("Models loaded from %s only hold compiled "
+                             "weights; refit to update" % self._loaded_from)
+        new_classes = label_names(y) - self._all_classes
+        if new_classes:
+            if verbose:
+                print("New classes: ", new_classes)
+            self._all_classes |= new_classes
+            self._regrow(tree.ArrayTree.from_labels(self._all_classes))
+        # A learned vocabulary is fixed, but hashed IDF statistics can grow
+        X = self._vectorize(X, learn=self.hashing)
+        index = label_index(y)
+        every_row = np.arange(len(y))
+        names, parent = self._tree.names, self._tree.parent
+        nodes, jobs = [], []
+        for i in range(1, len(self._tree)):
+            if parent[i] == 0:
+                rows = every_row
+            elif names[parent[i]] in index:
+                rows = index[names[parent[i]]]
+            else:
+                continue  # Nothing in this batch concerns the node
+            nodes.append(i)
+            jobs.append(delayed(_update_node)(
+                self._models[i] or self._node_model(),
+                self._priors[i], self._seen[i],
+                X, np.isin(rows, index.get(names[i], [])), rows))
+        updated = Parallel(n_jobs=self.n_jobs, backend=self.backend,
+                           verbose=10 if verbose else 0)(jobs)
+        for i, (clf, prior, seen) in zip(nodes, updated):
+            self._models[i] = clf
+            self._priors[i] = prior
+            self._seen[i] = seen
+        if self._weights is not None:  # Keep the compiled form current
+            self.compile(sparse=sp.issparse(self._weights))
+        return self
+
+    def _regrow(self, grown):
+        """Move per-node state over to a tree with more nodes in it."""
+        old = [self._tree.ids.get(name) for name in grown.names]
+        self._models = [None if o is None else self._models[o] for o in old]
+        self._priors = np.array(
+            [0. if o is None else self._priors[o] for o in old])
+        self._seen = np.array(
+            [0 if o is None else self._seen[o] for o in old])
+        self._tree = grown
+
+    def _vectorize(self, X, learn=False):
+        """Turn raw text into the sparse features all node models share.
+
+        Args:
+            X (pandas.Series): Raw text.
+            learn (bool): Fit the vocabulary, or with :attr:`hashing`, add
+                `X` to the IDF statistics.
+        """
+        if not self.hashing:
+            if learn:
+                return self._features.fit_transform(X).tocsr()
+            return self._features.transform(X).tocsr()
+        # Hashing is stateless, so chunks can be hashed in parallel
+        counts = transform_chunks(self._features.named_steps['vect'], X,
+                                  n_jobs=self.n_jobs)
+        tfidf = self._features.named_steps['tfidf']
+        if learn:
+            tfidf.partial_fit(counts)
+        return tfidf.transform(counts)
+
+    def _node_model(self):
+        """Returns an untrained model for a single node."""
+        return SGDClassifier(
+            loss='hinge', penalty='l2', alpha=self.alpha, max_iter=5,
+            tol=None, random_state=42)
 
     def predict(self, X):
         """Create a predicted network of labels for the actual label.
 
+        Descends the tree from the root one level at a time. A node's
+        probability is its parent's times its own model's confidence, and
+        only the children of nodes reaching :attr:`threshold`, up to
+        :attr:`beam_width` of them per level, are ever scored.
+
+        Args:
+            X (pandas.Series): Raw text.
         Returns:
-            (dict[string]float32): Probability by node name.
+            (List[dict[string]float32]): Probability by node name, for each
+            document. Nodes which were pruned away are absent.
+        """
+        X = self._vectorize(X)
+        n_docs = X.shape[0]
+        conf = None
+        if self._weights is not None:  # Score every node in one go
+            conf = expit(self._decide(X))
+        predictions = [{} for _ in range(n_docs)]
+        names = self._tree.names
+        # Documents, with their probabilities, waiting at each node
+        frontier = {0: (np.arange(n_docs), np.ones(n_docs))}
+        while frontier:
+            scored = []
+            for node, (rows, probs) in frontier.items():
+                X_node = take_rows(X, rows) if conf is None else None
+                for child in self._tree.children(node):
+                    if conf is None:
+                        p = probs * self._node_proba(child, X_node)
+                    else:  # Column j holds node j + 1, skipping the root
+                        p = probs * conf[rows, child - 1]
+                    scored.append((child, rows, p))
+                    name = names[child]
+                    for row, prob in zip(rows, p):
+                        predictions[row][name] = prob
+            frontier = self._prune(scored)
+        return predictions
+
+    def compile(self, sparse=False):
+        """Stack every node model into a single weight matrix.
+
+        Column ``j`` holds the coefficients of node ``self._nodes[j]``, the
+        node with ID ``j + 1``, so scoring a batch against the whole
+        hierarchy becomes one sparse by dense product, instead of a call per
+        node. :meth:`predict` then uses it, and pruning only decides which
+        nodes are reported.
+
+        A model from :func:`load_model` has no node models left to stack,
+        so its weights are only converted to the requested form.
+
+        Args:
+            sparse (bool): Keep the weights as a sparse matrix, which pays
+                off when most features are never used.
         """
-        return None
+        if getattr(self, '_loaded_from', None) is not None:
+            W = self._weights
+            if sparse and not sp.issparse(W):
+                self._weights = sp.csc_matrix(W)
+            elif not sparse and sp.issparse(W):
+                self._weights = W.toarray()
+            return self
+        self._nodes = self._tree.names[1:]
+        shape = (self._n_features, len(self._nodes))
+        b = np.zeros(len(self._nodes))
+        if sparse:  # Gather nonzeros column by column; never go dense
+            data, indices, indptr = [], [], [0]
+        else:
+            W = np.zeros(shape)
+        for j, clf in enumerate(self._models[1:]):
+            if clf is None:
+                # A zero column plus the prior's logit reproduces the prior
+                b[j] = logit(self._priors[j + 1])
+                if sparse:
+                    indptr.append(indptr[-1])
+                continue
+            b[j] = clf.intercept_[0]
+            if sparse:
+                rows = np.flatnonzero(clf.coef_[0])
+                indices.append(rows)
+                data.append(clf.coef_[0][rows])
+                indptr.append(indptr[-1] + len(rows))
+            else:
+                W[:, j] = clf.coef_[0]
+        if sparse:
+            W = sp.csc_matrix(
+                (np.concatenate(data or [np.zeros(0)]),
+                 np.concatenate(indices or [np.zeros(0, dtype=np.int32)]),
+                 indptr), shape=shape)
+        self._weights = W
+        self._intercepts = b
+        return self
+
+    def decision_matrix(self, X):
+        """Score documents against every node of a compiled model.
+
+        A model that hasn't been compiled yet is compiled first, densely.
+
+        Args:
+            X (pandas.Series): Raw text.
+        Returns:
+            numpy.ndarray: Decision values, one row per document and one
+            column per node, ordered as ``self._nodes``.
+        """
+        if self._weights is None:
+            self.compile()
+        return self._decide(self._vectorize(X))
+
+    def _decide(self, X):
+        scores = X.dot(self._weights)
+        if sp.issparse(scores):
+            scores = scores.toarray()
+        return scores + self._intercepts
+
+    def _node_proba(self, node, X):
+        """Probability that documents under a node's parent belong to it."""
+        clf = self._models[node]
+        if clf is None:
+            return np.full(X.shape[0], self._priors[node])
+        return expit(clf.decision_function(X))
+
+    def _prune(self, scored):
+        """Choose which of one level's scored nodes to descend into.
+
+        Args:
+            scored (List[(node, rows, probs)]): Probabilities per node for
+                the documents which reached it.
+        Returns:
+            dict[node, (rows, probs)]: The new frontier.
+        """
+        if not scored:
+            return {}
+        nodes = np.concatenate([np.full(len(r), i)
+                                for i, (_, r, _) in enumerate(scored)])
+        rows = np.concatenate([r for _, r, _ in scored])
+        probs = np.concatenate([p for _, _, p in scored])
+        keep = probs >= self.threshold
+        nodes, rows, probs = nodes[keep], rows[keep], probs[keep]
+        if self.beam_width is not None:
+            # Rank nodes within each document, most probable first
+            order = np.lexsort((-probs, rows))
+            nodes, rows, probs = nodes[order], rows[order], probs[order]
+            starts = np.r_[0, np.flatnonzero(np.diff(rows)) + 1]
+            rank = np.arange(len(rows)) - np.repeat(
+                starts, np.diff(np.r_[starts, len(rows)]))
+            keep = rank < self.beam_width
+            nodes, rows, probs = nodes[keep], rows[keep], probs[keep]
+        frontier = {}
+        for i in np.unique(nodes):
+            mask = nodes == i
+            frontier[scored[i][0]] = (rows[mask], probs[mask])
+        return frontier
 
     def score(self, X, y):
         """Compare the quality of the label.
@@ -82,16 +362,196 @@ class HierarchicalClassifier(BaseEstimator, ClassifierMixin):
         return 1
 
 
-def build_pipeline(clf, X, y):
-    pl = Pipeline([
+class StreamingTfidfTransformer(BaseEstimator, TransformerMixin):
+    """TF-IDF weighting that learns document frequencies chunk by chunk.
+
+    Once every chunk has been through :meth:`partial_fit`, it weighs terms
+    the same as a smoothed :class:`TfidfTransformer` fit on the whole
+    corpus, without ever holding the corpus.
+    """
+
+    def __init__(self, norm='l2', use_idf=True):
+        self.norm = norm
+        self.use_idf = use_idf
+
+    def fit(self, X, y=None):
+        for attr in ('df_', 'n_docs_'):
+            self.__dict__.pop(attr, None)
+        return self.partial_fit(X)
+
+    def partial_fit(self, X, y=None):
+        """Add a chunk of term counts to the document frequencies."""
+        X = sp.csr_matrix(X)
+        X.eliminate_zeros()
+        if not hasattr(self, 'df_'):
+            self.df_ = np.zeros(X.shape[1], dtype=np.int64)
+            self.n_docs_ = 0
+        self.df_ += np.bincount(X.indices, minlength=X.shape[1])
+        self.n_docs_ += X.shape[0]
+        return self
+
+    @property
+    def idf_(self):
+        return np.log((1. + self.n_docs_) / (1. + self.df_)) + 1.
+
+    def transform(self, X):
+        X = sp.csr_matrix(X, dtype=np.float64, copy=True)
+        if self.use_idf:
+            X.data *= self.idf_[X.indices]
+        if self.norm:
+            X = normalize(X, norm=self.norm, copy=False)
+        return X
+
+
+def build_features(hashing=False, n_features=2 ** 18):
+    """Returns an untrained pipeline turning raw text into TF-IDF features.
+
+    Args:
+        hashing (bool): Hash words into a fixed number of features instead
+            of learning a vocabulary. Memory then stays flat as the corpus
+            grows, nothing needs fitting before text can be vectorized, and
+            IDF statistics are gathered incrementally.
+        n_features (int): Number of hashed features.
+    """
+    if hashing:
+        return Pipeline([
+            ('vect', HashingVectorizer(
+                stop_words='english', strip_accents='unicode',
+                analyzer='word', n_features=n_features,
+                alternate_sign=False, norm=None)),
+            ('tfidf', StreamingTfidfTransformer()),
+        ])
+    return Pipeline([
         ('vect', CountVectorizer(
             stop_words='english', strip_accents='unicode', analyzer='word')),
         ('tfidf', TfidfTransformer()),
-        ('clf', clf)
     ])
+
+
+def transform_chunks(transformer, X, chunk_size=10000, n_jobs=1):
+    """Apply a stateless transformer to chunks of `X` in parallel.
+
+    Returns:
+        :class:`scipy.sparse.csr_matrix` of the stacked results.
+    """
+    if n_jobs == 1 or len(X) <= chunk_size:
+        return transformer.transform(X).tocsr()
+    chunks = (take_rows(X, slice(i, i + chunk_size))
+              for i in range(0, len(X), chunk_size))
+    parts = Parallel(n_jobs=n_jobs)(
+        delayed(transformer.transform)(chunk) for chunk in chunks)
+    return sp.vstack(parts).tocsr()
+
+
+def build_pipeline(clf, X=None, y=None, hashing=False):
+    """Bundle text vectorization with `clf`, training it if given data."""
+    pl = Pipeline(build_features(hashing).steps + [('clf', clf)])
+    if X is None:
+        return pl
     return pl.fit(X, y)
 
 
+def label_names(y):
+    """Returns the set of label names used in `y`."""
+    if isinstance(y, util.LabelColumn):
+        return set(y.vocabulary.decode(util.collapse_unique(y)))
+    return util.collapse_unique(y)
+
+
+def label_index(y):
+    """Build an inverted index from each label, and its ancestors, to rows.
+
+    Args:
+        y (Iterable[List[str]]): Labels per document, or a
+            :class:`matchwell.util.LabelColumn`, which is indexed with
+            sparse matrix products rather than row by row.
+    Returns:
+        dict[str, numpy.ndarray]: Sorted row numbers by label.
+    """
+    if isinstance(y, util.LabelColumn):
+        return _label_column_index(y)
+    index = {}
+    for row, labels in enumerate(y):
+        for label in tree.ancestry(labels):
+            index.setdefault(label, []).append(row)
+    return {label: np.array(rows) for label, rows in index.items()}
+
+
+def _label_column_index(y):
+    # Map each label to itself and its ancestors, which may not be interned
+    # yet, without adding them to the caller's vocabulary
+    names = list(y.vocabulary.names)
+    ids = dict(y.vocabulary.ids)
+    indices, indptr = [], [0]
+    for name in y.vocabulary.names:
+        for ancestor in tree.ancestry([name]):
+            if ancestor not in ids:
+                ids[ancestor] = len(names)
+                names.append(ancestor)
+            indices.append(ids[ancestor])
+        indptr.append(len(indices))
+    lineage = sp.csr_matrix(
+        (np.ones(len(indices), dtype=np.int32), indices, indptr),
+        shape=(len(y.vocabulary), len(names)))
+    # (rows, labels) x (labels, ancestors), then each column's rows
+    members = (y.indicator().astype(np.int32) * lineage).tocsc()
+    members.sort_indices()
+    return {names[j]: members.indices[members.indptr[j]:members.indptr[j + 1]]
+            for j in range(len(names))
+            if members.indptr[j] < members.indptr[j + 1]}
+
+
+def take_rows(X, rows):
+    """Select rows by position from a Series, list, array or sparse matrix."""
+    if hasattr(X, 'iloc'):
+        return X.iloc[rows]
+    if isinstance(X, (list, tuple)):
+        return [X[i] for i in rows]
+    return X[rows]
+
+
+def _fit_node(clf, X, y, rows=None):
+    """Train one node's model.
+
+    Args:
+        clf: Untrained model.
+        X: Training data; only `rows` of it are used, if given.
+        y (numpy.ndarray): Binary targets, one per selected row.
+    Returns:
+        (clf, prior, seen): The trained model, the fraction of positive
+        examples, and the number of examples. The model is None when every
+        example agrees, as there's nothing to learn; the prior then answers
+        alone.
+    """
+    y = np.asarray(y, dtype=int)
+    prior = y.mean() if len(y) else 0.
+    if prior in (0., 1.):
+        return None, prior, len(y)
+    if rows is not None:
+        X = take_rows(X, rows)
+    return clf.fit(X, y), prior, len(y)
+
+
+def _update_node(clf, prior, seen, X, y, rows=None):
+    """Update one node's model with a new batch; see :func:`_fit_node`.
+
+    Args:
+        clf: The node's model; trained already, or not if it never had
+            both positive and negative examples.
+        prior (float): Fraction of positive examples so far.
+        seen (int): Number of examples so far.
+    """
+    y = np.asarray(y, dtype=int)
+    prior = (prior * seen + y.sum()) / max(seen + len(y), 1)
+    seen += len(y)
+    trained = hasattr(clf, 'coef_')
+    if not trained and len(np.unique(y)) < 2:
+        return None, prior, seen
+    if rows is not None:
+        X = take_rows(X, rows)
+    return clf.partial_fit(X, y, classes=np.array([0, 1])), prior, seen
+
+
 def grid_search(clf, params, X, y):
     gs_clf = GridSearchCV(clf, params, n_jobs=-1)
     gs_clf = gs_clf.fit(X, y)
@@ -99,15 +559,317 @@ def grid_search(clf, params, X, y):
 
 
 def grid_search_optimal_parameters(gs_clf):
-    best_params, score, _ = max(gs_clf.grid_scores_, key=lambda x: x[1])
-    return best_params
+    return gs_clf.best_params_
+
+
+class CachedGridSearch:
+    """Grid search over a text pipeline that vectorizes each fold once.
+
+    Pipelines from :func:`build_pipeline` spend most of their time turning
+    text into features, yet only the 'vect__' and 'tfidf__' parameters
+    change the features. Each distinct setting of those is fit once per
+    fold, and the cached matrices are reused by every classifier setting.
+
+    With `halving`, candidates are raced on growing slices of the training
+    folds, and only the best 1/`factor` of them go on to each next round,
+    so poor settings are dropped after training on a fraction of the data.
+
+    Attributes:
+        best_params_ (dict): Parameters of the highest scoring candidate.
+        best_score_ (float): Its mean score over the folds.
+        best_estimator_: The pipeline, refit on all data with those.
+        cv_results_ (List[dict]): Parameters, mean score, training rows and
+            round of every evaluation.
+        n_feature_fits_ (int): Times a feature pipeline was fit.
+    """
+
+    def __init__(self, pipeline, params, cv=3, scoring=None, halving=False,
+                 factor=3, min_resources=None, n_jobs=-1, backend=None,
+                 refit=True):
+        """
+        Args:
+            pipeline (:class:`sklearn.pipeline.Pipeline`): Feature steps,
+                ending with the classifier step.
+            params (dict): Grid of parameters, as for GridSearchCV.
+            cv (int): Number of folds.
+            scoring: Scorer name or callable; defaults to the classifier's
+                own score method.
+            halving (bool): Use successive halving rather than evaluating
+                every candidate on all of the data.
+            factor (int): Share of candidates kept, and growth of training
+                rows, between halving rounds.
+            min_resources (int): Training rows per fold in the first round;
+                defaults to what leaves one candidate on all of the data.
+            n_jobs (int): Parallel fits; -1 for one per CPU.
+            backend (str): joblib backend for those fits.
+            refit (bool): Refit the best candidate on all of the data.
+        """
+        self.pipeline = pipeline
+        self.params = params
+        self.cv = cv
+        self.scoring = scoring
+        self.halving = halving
+        self.factor = factor
+        self.min_resources = min_resources
+        self.n_jobs = n_jobs
+        self.backend = backend
+        self.refit = refit
+
+    def fit(self, X, y):
+        y = np.asarray(y)
+        clf_name = self.pipeline.steps[-1][0]
+        prefix = clf_name + '__'
+        feature_grid = list(ParameterGrid(
+            {k: v for k, v in self.params.items()
+             if not k.startswith(prefix)}))
+        clf_grid = list(ParameterGrid(
+            {k[len(prefix):]: v for k, v in self.params.items()
+             if k.startswith(prefix)}))
+        # Training rows are shuffled, so any leading slice is a fair sample;
+        # for classifiers, one that holds every class in proportion
+        classify = is_classifier(self.pipeline)
+        splitter = StratifiedKFold if classify else KFold
+        rng = np.random.RandomState(42)
+        folds = [(_slice_order(train, y[train] if classify else None, rng),
+                  test) for train, test in
+                 splitter(n_splits=self.cv, shuffle=True,
+                          random_state=42).split(np.zeros(len(y)), y)]
+        parallel = Parallel(n_jobs=self.n_jobs, backend=self.backend)
+
+        # Vectorize every fold under every feature setting, exactly once
+        keys = [(f, k) for f in range(len(feature_grid))
+                for k in range(len(folds))]
+        features = Pipeline(self.pipeline.steps[:-1])
+        matrices = parallel(
+            delayed(_vectorize_fold)(
+                clone(features).set_params(**feature_grid[f]),
+                X, folds[k])
+            for f, k in keys)
+        cache = dict(zip(keys, matrices))
+        self.n_feature_fits_ = len(cache)
+
+        candidates = [(f, c) for f in range(len(feature_grid))
+                      for c in range(len(clf_grid))]
+        n_train = min(len(train) for train, _ in folds)
+        rounds = [n_train]
+        if self.halving:
+            n_rounds = int(np.ceil(np.log(len(candidates)) /
+                                   np.log(self.factor)))
+            # Enough rows for a couple of examples of every class
+            n_classes = len(np.unique(y)) if classify else 1
+            first = max(self.min_resources or max(
+                n_train // self.factor ** n_rounds, 2 * n_classes),
+                n_classes)
+            rounds = []
+            while first < n_train and len(rounds) < n_rounds:
+                rounds.append(first)
+                first *= self.factor
+            rounds.append(n_train)
+
+        clf = self.pipeline.steps[-1][1]
+        scorer = get_scorer(self.scoring) if self.scoring else _default_score
+        self.cv_results_ = []
+        for i, n_rows in enumerate(rounds):
+            scores = parallel(
+                delayed(_score_fold)(
+                    clone(clf).set_params(**clf_grid[c]),
+                    cache[f, k], y[folds[k][0]], y[folds[k][1]], n_rows,
+                    scorer)
+                for f, c in candidates for k in range(len(folds)))
+            means = np.mean(np.reshape(scores, (len(candidates), -1)),
+                            axis=1)
+            for (f, c), mean in zip(candidates, means):
+                self.cv_results_.append({
+                    'params': self._params(feature_grid[f], clf_grid[c],
+                                           prefix),
+                    'mean_score': mean,
+                    'n_resources': n_rows,
+                    'iteration': i,
+                })
+            order = np.argsort(-means, kind='mergesort')
+            if i < len(rounds) - 1:  # Only the best go through
+                keep = int(np.ceil(len(candidates) / self.factor))
+                candidates = [candidates[j] for j in order[:keep]]
+            else:
+                best = candidates[order[0]]
+                self.best_score_ = means[order[0]]
+
+        self.best_params_ = self._params(feature_grid[best[0]],
+                                         clf_grid[best[1]], prefix)
+        if self.refit:
+            self.best_estimator_ = clone(self.pipeline).set_params(
+                **self.best_params_).fit(X, y)
+        return self
+
+    @staticmethod
+    def _params(feature_params, clf_params, prefix):
+        params = dict(feature_params)
+        params.update((prefix + k, v) for k, v in clf_params.items())
+        return params
+
+
+def _slice_order(rows, y, rng):
+    """Shuffle training rows so every leading slice is representative.
+
+    Given class labels `y`, one row of each class leads, and the rest
+    follow spread out in proportion to their class's size. So any slice at
+    least as long as the number of classes holds all of them, and longer
+    ones keep the class balance of the whole.
+    """
+    order = rng.permutation(len(rows))
+    if y is None:
+        return rows[order]
+    classes, labels, counts = np.unique(
+        y[order], return_inverse=True, return_counts=True)
+    rank = np.zeros(len(order))
+    for c in range(len(classes)):
+        members = np.flatnonzero(labels == c)
+        rank[members] = (np.arange(len(members)) + .5) / counts[c]
+        rank[members[0]] = -1.  # The first of each class goes up front
+    return rows[order[np.argsort(rank, kind='mergesort')]]
+
+
+def _vectorize_fold(features, X, fold):
+    """Fit features on a fold's training rows, then transform both splits.
+
+    Returns:
+        (X_train, X_test) as CSR matrices.
+    """
+    train, test = fold
+    X_train = features.fit_transform(take_rows(X, train)).tocsr()
+    return X_train, features.transform(take_rows(X, test)).tocsr()
+
+
+def _score_fold(clf, matrices, y_train, y_test, n_rows, scorer):
+    """Train on the first `n_rows` of a cached fold and score the rest."""
+    X_train, X_test = matrices
+    clf.fit(X_train[:n_rows], y_train[:n_rows])
+    return scorer(clf, X_test, y_test)
+
+
+def _default_score(clf, X, y):
+    return clf.score(X, y)
+
+
+#: Version of the on-disk :class:`HierarchicalClassifier` format. Version 2
+#: numbers nodes breadth-first, as :class:`matchwell.tree.ArrayTree` does.
+FORMAT_VERSION = 2
 
 
 def save_model(filename, clf):
+    """Save a model.
+
+    A :class:`HierarchicalClassifier` is saved as a directory of raw NumPy
+    arrays plus a small JSON manifest, which :func:`load_model` can
+    memory-map; it's compiled first, if need be. Anything else is pickled.
+    """
+    if isinstance(clf, HierarchicalClassifier):
+        return _save_hierarchical(filename, clf)
     with open(filename, 'wb') as f:
         pickle.dump(clf, f)
 
 
-def load_model(filename):
+def load_model(filename, mmap_mode='r'):
+    """Load a model saved by :func:`save_model`.
+
+    Args:
+        mmap_mode (str): How to map a HierarchicalClassifier's arrays; see
+            :func:`numpy.load`. The default, read-only mapping lets every
+            process loading the model share one physical copy of it.
+    """
+    if os.path.isdir(filename):
+        return _load_hierarchical(filename, mmap_mode)
     with open(filename, 'rb') as f:
         return pickle.load(f)
+
+
+def _save_hierarchical(path, clf):
+    """Write a compiled HierarchicalClassifier out as flat files.
+
+    Layout:
+        model.json: Format version, parameters, and node names & priors.
+        parents.npy: Index into the node names of each node's parent; -1
+            for the root, which is always first. Nodes are in breadth-first
+            order, and loading checks that they are.
+        weights.npy, intercepts.npy: The compiled weights; sparse weights
+            are kept as weights.{data,indices,indptr}.npy instead.
+        vocabulary.txt, idf.npy: A learned vocabulary, one term per line in
+            feature order, and its IDF weights.
+        df.npy: Document frequencies for hashed features.
+    """
+    if clf._weights is None:
+        clf.compile()
+    os.makedirs(path, exist_ok=True)
+    meta = {
+        'version': FORMAT_VERSION,
+        'params': clf.get_params(),
+        'nodes': clf._tree.names,
+        'priors': clf._priors.tolist(),
+        'n_features': clf._n_features,
+        'sparse': sp.issparse(clf._weights),
+    }
+    np.save(os.path.join(path, 'parents.npy'), clf._tree.parent)
+    if meta['sparse']:
+        for attr in ('data', 'indices', 'indptr'):
+            np.save(os.path.join(path, 'weights.%s.npy' % attr),
+                    getattr(clf._weights, attr))
+    else:
+        np.save(os.path.join(path, 'weights.npy'), clf._weights)
+    np.save(os.path.join(path, 'intercepts.npy'), clf._intercepts)
+    tfidf = clf._features.named_steps['tfidf']
+    if clf.hashing:
+        meta['n_docs'] = tfidf.n_docs_
+        np.save(os.path.join(path, 'df.npy'), tfidf.df_)
+    else:
+        vect = clf._features.named_steps['vect']
+        # Loaded models carry their vocabulary as a parameter, unfitted
+        vocab = getattr(vect, 'vocabulary_', None) or \
+            vect.get_params()['vocabulary']
+        with open(os.path.join(path, 'vocabulary.txt'), 'w',
+                  encoding='utf-8') as f:
+            f.write('\n'.join(sorted(vocab, key=vocab.get)))
+        np.save(os.path.join(path, 'idf.npy'), tfidf.idf_)
+    with open(os.path.join(path, 'model.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+def _load_hierarchical(path, mmap_mode='r'):
+    """Rebuild a compiled, inference-only HierarchicalClassifier."""
+    def load(name):
+        return np.load(os.path.join(path, name), mmap_mode=mmap_mode)
+
+    with open(os.path.join(path, 'model.json')) as f:
+        meta = json.load(f)
+    if meta['version'] != FORMAT_VERSION:
+        raise ValueError("%s holds model format version %s; expected %s" %
+                         (path, meta['version'], FORMAT_VERSION))
+    clf = HierarchicalClassifier(**meta['params'])
+    clf._tree = tree.ArrayTree(meta['nodes'], load('parents.npy'))
+    clf._nodes = clf._tree.names[1:]
+    clf._models = [None] * len(clf._tree)
+    clf._priors = np.array(meta['priors'])
+    clf._all_classes = set(clf._nodes)
+    clf._n_features = meta['n_features']
+    if meta['sparse']:
+        clf._weights = sp.csc_matrix(
+            tuple(load('weights.%s.npy' % a)
+                  for a in ('data', 'indices', 'indptr')),
+            shape=(meta['n_features'], len(clf._nodes)), copy=False)
+    else:
+        clf._weights = load('weights.npy')
+    clf._intercepts = load('intercepts.npy')
+
+    clf._features = build_features(clf.hashing, clf.n_features)
+    tfidf = clf._features.named_steps['tfidf']
+    if clf.hashing:
+        tfidf.df_ = load('df.npy')
+        tfidf.n_docs_ = meta['n_docs']
+    else:
+        with open(os.path.join(path, 'vocabulary.txt'),
+                  encoding='utf-8') as f:
+            terms = f.read().split('\n')
+        clf._features.named_steps['vect'].set_params(
+            vocabulary={t: i for i, t in enumerate(terms)})
+        tfidf.idf_ = load('idf.npy')
+    clf._loaded_from = path
+    return clf
@@ -18,3 +18,17 @@ class Sourcerer(abc.ABC):
             A new :class:`pandas.DataFrame`, of only this source's type.
         """
         pass
+
+    def pull_iter(self, *, chunk_size=1000, **kwargs):
+        """Retrieve updates as a stream of bounded-size frames.
+
+        Sources able to stream should override this; by default, everything
+        is pulled at once and then sliced. Arguments are keyword-only, as
+        sources put their own query arguments first in :meth:`pull`.
+
+        Yields:
+            :class:`pandas.DataFrame` of at most `chunk_size` rows.
+        """
+        df = self.pull(**kwargs)
+        for start in range(0, len(df), chunk_size):
+            yield df.iloc[start:start + chunk_size]
@@ -0,0 +1,146 @@
+"""
+store
+=====
+A local, columnar store of pulled messages.
+
+Frames from :meth:`Sourcerer.pull` are appended as Parquet files, partitioned
+by source type and date::
+
+    <root>/type=gmail/date=2016-06-29/part-<uuid>.parquet
+
+A JSON manifest records every part's row count and time span, so reads can
+skip irrelevant partitions and questions like "what's the newest message?"
+are answered without reading any rows. Requires a Parquet engine, e.g.
+``pip install matchwell[store]``.
+"""
+import json
+import os
+import uuid
+
+import pandas as pd
+
+from matchwell import util
+
+
+class MessageStore:
+    """Appends, dedupes and reads back message frames on disk."""
+    manifest_file = '_manifest.json'
+    ids_file = '_ids.parquet'
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._manifest = self._load_manifest()
+        self._ids = None
+
+    def __len__(self):
+        return sum(p['rows'] for p in self._manifest)
+
+    @property
+    def ids(self):
+        """Set of every stored message ID."""
+        if self._ids is None:
+            path = os.path.join(self.root, self.ids_file)
+            if os.path.exists(path):
+                self._ids = set(pd.read_parquet(path)['id'])
+            else:
+                self._ids = set()
+        return self._ids
+
+    def append(self, df):
+        """Store the rows of `df` whose ``id`` isn't stored already.
+
+        Args:
+            df (:class:`pandas.DataFrame`): Frame with the columns of
+                :func:`util.new_data_frame`.
+        Returns:
+            int: Number of rows written.
+        """
+        df = df[~df['id'].isin(self.ids)].drop_duplicates('id')
+        if not len(df):
+            return 0
+        df = df.assign(raw=df['raw'].map(json.dumps))
+        dates = df['timestamp'].dt.strftime('%Y-%m-%d')
+        for (typ, date), part in df.groupby([df['type'], dates]):
+            path = os.path.join('type=%s' % typ, 'date=%s' % date,
+                                'part-%s.parquet' % uuid.uuid4().hex)
+            full_path = os.path.join(self.root, path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            part.to_parquet(full_path, index=False)
+            self._manifest.append({
+                'path': path,
+                'type': typ,
+                'date': date,
+                'rows': len(part),
+                'min_ts': part['timestamp'].min().isoformat(),
+                'max_ts': part['timestamp'].max().isoformat(),
+            })
+        self.ids.update(df['id'])
+        self._save()
+        return len(df)
+
+    def read(self, columns=None, start=None, end=None, types=None):
+        """Read stored messages back.
+
+        Only partitions overlapping the time range are opened, and only the
+        requested columns are read from them; leave out 'raw' to skip the
+        bulky message payloads entirely.
+
+        Args:
+            columns (List[str]): Columns to read; defaults to all.
+            start: Earliest timestamp to include.
+            end: Timestamp to stop before.
+            types (Iterable[str]): Source types to include; defaults to all.
+        Returns:
+            :class:`pandas.DataFrame`
+        """
+        start = pd.Timestamp(start) if start is not None else None
+        end = pd.Timestamp(end) if end is not None else None
+        parts = [p for p in self._manifest
+                 if (types is None or p['type'] in types) and
+                 (start is None or pd.Timestamp(p['max_ts']) >= start) and
+                 (end is None or pd.Timestamp(p['min_ts']) < end)]
+        wanted = list(columns or util.new_data_frame().columns)
+        # The timestamp is needed to trim partitions straddling the range
+        to_read = wanted
+        if (start is not None or end is not None) and \
+                'timestamp' not in wanted:
+            to_read = wanted + ['timestamp']
+        if not parts:
+            return util.new_data_frame()[wanted]
+
+        df = pd.concat(
+            [pd.read_parquet(os.path.join(self.root, p['path']),
+                             columns=to_read) for p in parts],
+            ignore_index=True)
+        if start is not None:
+            df = df[df['timestamp'] >= start]
+        if end is not None:
+            df = df[df['timestamp'] < end]
+        if 'raw' in df:
+            df['raw'] = df['raw'].map(json.loads)
+        return df[wanted].reset_index(drop=True)
+
+    def newest(self):
+        """Return the newest stored timestamp, read from metadata alone."""
+        if not self._manifest:
+            return None
+        return max(pd.Timestamp(p['max_ts']) for p in self._manifest)
+
+    def _load_manifest(self):
+        path = os.path.join(self.root, self.manifest_file)
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return json.load(f)
+
+    def _save(self):
+        # Write aside and rename, so a crash can't leave a torn manifest
+        ids_path = os.path.join(self.root, self.ids_file)
+        pd.DataFrame({'id': sorted(self.ids)}).to_parquet(
+            ids_path + '.tmp', index=False)
+        os.replace(ids_path + '.tmp', ids_path)
+        path = os.path.join(self.root, self.manifest_file)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self._manifest, f, indent=2)
+        os.replace(path + '.tmp', path)
@@ -0,0 +1,50 @@
+import pytest
+
+from matchwell.cache import MessageCache
+
+
+def message(msg_id, labels=('INBOX',), size=10):
+    return {'id': msg_id, 'labelIds': list(labels),
+            'payload': {'body': {'data': msg_id * size}}}
+
+
+@pytest.fixture()
+def cache(tmpdir):
+    c = MessageCache(str(tmpdir.join('messages.sqlite')))
+    yield c
+    c.close()
+
+
+def test_put_get(cache):
+    msg = message('a')
+    cache.put(msg)
+    assert 'a' in cache
+    assert cache.get('a') == msg
+    assert cache.get('b') is None
+    assert len(cache) == 1
+
+
+def test_invalidate_labels(cache):
+    cache.put_many([message('a'), message('b')])
+    cache.invalidate_labels(['a'])
+    found = cache.get_many(['a', 'b'])
+    assert 'labelIds' not in found['a']
+    assert found['b']['labelIds'] == ['INBOX']
+
+    cache.put_labels({'a': ['SENT']})
+    assert cache.get('a')['labelIds'] == ['SENT']
+
+    cache.invalidate_labels()
+    assert 'labelIds' not in cache.get('b')
+
+
+def test_evicts_least_recently_used(tmpdir):
+    cache = MessageCache(str(tmpdir.join('messages.sqlite')))
+    cache.put_many([message('a'), message('b')])
+    cache.max_bytes = cache.size()
+    cache.get('a')  # Now more recently used than 'b'
+    cache.put(message('c'))
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert 'c' in cache
+    assert cache.size() <= cache.max_bytes
@@ -1,13 +1,17 @@
 import base64
 import itertools
+import threading
+import time
 import uuid
-from collections import namedtuple
-from unittest.mock import patch
+from collections import Counter, namedtuple
+from unittest.mock import MagicMock, patch
 
 import pytest
 import pandas as pd
+from apiclient import errors
 
-from matchwell import gmail
+from matchwell import gmail, util
+from matchwell.cache import MessageCache
 from matchwell.gmail import GmailSource
 
 
@@ -72,9 +76,9 @@ def test_gmail_source_pull(mock_ex, mock_tf):
     mock_tf.assert_called_with(gs, messages)
 
 
-@patch('matchwell.gmail.Gmail', autospec=True)
-def test_gmail_source_extract(mock_gmail):
-    gs = gmail.GmailSource()
+def test_gmail_source_extract():
+    mock_gmail = MagicMock(spec=gmail.Gmail)
+    gs = gmail.GmailSource(gmail=mock_gmail)
     id_list = [
         [{'msgId': junk(), 'threadId': junk()}],
         [{'msgId': junk(), 'threadId': junk()}],
@@ -82,12 +86,300 @@ def test_gmail_source_extract(mock_gmail):
     ]
     msg_list = [[{'id': m[0]['msgId']}] for m in id_list]
     # Mock the continuous yield of the generator list_messages
-    mock_gmail.return_value.list_messages.return_value = iter(id_list)
-    mock_gmail.return_value.download_emails.side_effect = msg_list
+    mock_gmail.list_messages.return_value = iter(id_list)
+    mock_gmail.download_pages.return_value = iter(msg_list)
 
     exp = list(itertools.chain.from_iterable(msg_list))
     obs = gs._extract(query=None)
     assert obs == exp
+    mock_gmail.download_pages.assert_called_with(
+        mock_gmail.list_messages.return_value)
+
+
+@patch.object(GmailSource, '_transform', autospec=True)
+def test_gmail_source_pull_iter(mock_tf):
+    mock_gmail = MagicMock(spec=gmail.Gmail)
+    gs = gmail.GmailSource(gmail=mock_gmail)
+    pages = [[{'id': junk()} for _ in range(n)] for n in (3, 1, 4)]
+    mock_gmail.download_pages.return_value = iter(pages)
+    mock_tf.side_effect = lambda self, msgs: pd.DataFrame(
+        {'id': [m['id'] for m in msgs]})
+
+    chunks = list(gs.pull_iter(newer_than='2016/06/01', chunk_size=3))
+
+    mock_gmail.list_messages.assert_called_with(query='after:2016/06/01')
+    assert [len(c) for c in chunks] == [3, 3, 2]
+    exp = [m['id'] for m in itertools.chain.from_iterable(pages)]
+    assert list(pd.concat(chunks)['id']) == exp
+    assert gs.raw is None
+    # A bare number can't be mistaken for a query
+    with pytest.raises(TypeError):
+        gs.pull_iter(500)
+
+
+def test_gmail_source_state(tmpdir):
+    path = str(tmpdir.join('gmail-state.json'))
+    gs = gmail.GmailSource(gmail=MagicMock(spec=gmail.Gmail))
+    assert gs.load_state(path).history_id is None  # First run
+    gs.history_id = '1234'
+    gs.save_state(path)
+    # A new process picks up where the last one left off
+    later = gmail.GmailSource(gmail=MagicMock(spec=gmail.Gmail))
+    assert later.load_state(path).history_id == '1234'
+
+
+@patch.object(GmailSource, '_transform', autospec=True)
+def test_gmail_source_sync(mock_tf):
+    mock_gmail = MagicMock(spec=gmail.Gmail)
+    mock_gmail.cache = None
+    gs = gmail.GmailSource(gmail=mock_gmail)
+    gs.history_id = '100'
+    mock_gmail.list_history.return_value = iter([
+        {'history': [
+            {'messagesAdded': [{'message': {'id': 'a'}}]},
+            {'labelsAdded': [{'message': {'id': 'b'}},
+                             {'message': {'id': 'a'}}]},
+            {'messagesAdded': [{'message': {'id': 'c'}}]},
+         ],
+         'historyId': '105',
+         'nextPageToken': 'next'},
+        {'history': [
+            {'messagesDeleted': [{'message': {'id': 'c'}},
+                                 {'message': {'id': 'd'}}]},
+         ],
+         'historyId': '110'},
+    ])
+    mock_gmail.download_emails.return_value = [{'id': 'a'}, {'id': 'b'}]
+    mock_tf.side_effect = lambda self, msgs: pd.DataFrame(
+        {'id': [m['id'] for m in msgs], 'type': 'gmail'})
+
+    delta = gs.sync()
+
+    mock_gmail.list_history.assert_called_with('100')
+    mock_gmail.download_emails.assert_called_with([{'id': 'a'},
+                                                   {'id': 'b'}])
+    changes = dict(zip(delta['id'], delta['change']))
+    assert changes == {'a': 'added', 'b': 'labels',
+                       'c': 'deleted', 'd': 'deleted'}
+    assert gs.history_id == '110'
+
+
+def test_gmail_source_sync_requires_history():
+    with pytest.raises(ValueError):
+        gmail.GmailSource(gmail=MagicMock(spec=gmail.Gmail)).sync()
+
+
+def fake_message(msg_id, text, label_ids=(), internal_date='1467232146000'):
+    data = base64.urlsafe_b64encode(text.encode()).decode()
+    return {'id': msg_id, 'internalDate': internal_date,
+            'labelIds': list(label_ids),
+            'payload': {'mimeType': 'text/plain', 'body': {'data': data}}}
+
+
+def test_gmail_source_transform():
+    mock_gmail = MagicMock(spec=gmail.Gmail)
+    mock_gmail.label_ids = {'Label_1': 'Work', 'Label_2': 'Work/Foo',
+                            'CHAT': 'CHAT', 'INBOX': 'INBOX'}
+    gs = gmail.GmailSource(gmail=mock_gmail)
+    messages = [
+        fake_message('a', 'hello', ['Label_1', 'CHAT']),
+        {'id': 'b', 'internalDate': '0', 'payload': {'mimeType': 'image/png'}},
+        fake_message('c', 'world', ['Label_2', 'INBOX'], '1467227159000'),
+    ]
+
+    df = gs._transform(messages)
+
+    assert list(df.columns) == list(util.new_data_frame().columns)
+    assert list(df['id']) == ['a', 'c']
+    assert list(df['text']) == ['hello', 'world']
+    assert list(df['labels']) == [['Work'], ['Work/Foo', 'INBOX']]
+    assert list(df['type']) == ['gmail', 'gmail']
+    assert df['raw'][1] is messages[2]
+    assert df['timestamp'].dtype.kind == 'M'
+    assert str(df['timestamp'][1]) == '2016-06-29 19:05:59'
+
+
+def test_gmail_source_compact():
+    mock_gmail = MagicMock(spec=gmail.Gmail)
+    mock_gmail.label_ids = {}
+    messages = [fake_message('a', 'hello'), fake_message('b', 'world')]
+    mock_gmail.download_emails.return_value = messages
+    gs = gmail.GmailSource(gmail=mock_gmail, compact=True)
+
+    df = gs._transform(messages)
+    assert df['raw'].isnull().all()
+    assert list(df['text']) == ['hello', 'world']
+
+    raw = gs.resolve_raw(df['id'])
+    mock_gmail.download_emails.assert_called_with([{'id': 'a'},
+                                                   {'id': 'b'}])
+    assert raw['b'] is messages[1]
+
+
+def test_gmail_source_reuses_pool():
+    mock_gmail = MagicMock(spec=gmail.Gmail)
+    mock_gmail.label_ids = {}
+    messages = [fake_message(str(i), 'text %d' % i) for i in range(6)]
+    with gmail.GmailSource(gmail=mock_gmail, workers=2, task_size=2) as gs:
+        pool = gs.pool
+        assert pool._mp_context.get_start_method() != 'fork'
+        for _ in range(2):
+            df = gs._transform(messages)
+            assert list(df['text']) == ['text %d' % i for i in range(6)]
+        assert gs.pool is pool
+    assert gs._pool is None
+
+
+def test_gmail_source_transform_empty():
+    mock_gmail = MagicMock(spec=gmail.Gmail)
+    mock_gmail.label_ids = {}
+    df = gmail.GmailSource(gmail=mock_gmail)._transform([])
+    assert len(df) == 0
+
+
+class FakeBatch:
+    """Stands in for :class:`apiclient.http.BatchHttpRequest`."""
+
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self, http=None):
+        with self.service.lock:
+            self.service.in_flight += 1
+            self.service.max_in_flight = max(self.service.max_in_flight,
+                                             self.service.in_flight)
+        time.sleep(.001)
+        try:
+            self._execute()
+        finally:
+            with self.service.lock:
+                self.service.in_flight -= 1
+
+    def _execute(self):
+        for msg_id, request in self.requests:
+            calls = self.service.calls[msg_id] = \
+                self.service.calls[msg_id] + 1
+            if calls <= self.service.throttle.get(msg_id, 0):
+                resp = namedtuple('Response', ('status', 'reason'))(429, '')
+                exc = errors.HttpError(resp, b'Rate Limit Exceeded')
+                self.callback(msg_id, None, exc)
+            else:
+                self.service.formats[request['format']] += 1
+                self.callback(msg_id, {'id': msg_id, 'labelIds': ['INBOX']},
+                              None)
+
+
+class FakeService:
+    """Serves messages by ID, throttling some for a number of attempts."""
+
+    def __init__(self, throttle=None, pages=()):
+        self.throttle = throttle or {}
+        self.pages = list(pages)
+        self.calls = Counter()
+        self.formats = Counter()
+        self.batches = 0
+        self.lock = threading.Lock()
+        self.in_flight = self.max_in_flight = 0
+
+    def new_batch_http_request(self, callback):
+        self.batches += 1
+        return FakeBatch(self, callback)
+
+    def users(self):
+        users = MagicMock()
+        users.messages.return_value.get.side_effect = lambda **kw: kw
+        users.messages.return_value.list.side_effect = self._list
+        return users
+
+    def _list(self, pageToken=0, **kwargs):
+        """Serves :attr:`pages` of message IDs, as messages.list."""
+        page = int(pageToken)
+        response = {'messages': [{'id': i} for i in self.pages[page]],
+                    'resultSizeEstimate': len(self.pages[page])}
+        if page + 1 < len(self.pages):
+            response['nextPageToken'] = str(page + 1)
+        request = MagicMock()
+        request.execute.return_value = response
+        return request
+
+
+def test_download_emails_batches_and_retries():
+    ids = [junk() for _ in range(25)]
+    service = FakeService(throttle={ids[0]: 1, ids[7]: 2})
+    g = gmail.Gmail(service=service, batch_size=10, max_workers=3)
+    g.backoff = gmail.Backoff(initial=0.)
+
+    emails = g.download_emails([{'id': i} for i in ids])
+
+    # Every message arrives, in request order, despite throttling
+    assert [e['id'] for e in emails] == ids
+    assert service.calls[ids[7]] == 3
+    assert service.batches == 3 + 2  # Initial batches, then two retries
+
+
+def test_download_emails_cached(tmpdir):
+    ids = [junk() for _ in range(4)]
+    service = FakeService()
+    g = gmail.Gmail(service=service,
+                    cache=MessageCache(str(tmpdir.join('cache.sqlite'))))
+    msgs = [{'id': i} for i in ids]
+
+    first = g.download_emails(msgs[:3])
+    second = g.download_emails(msgs)
+    assert first == second[:3]
+    assert service.formats == {'full': 4}
+
+    # Only labels are refreshed after invalidation
+    g.cache.invalidate_labels(ids[:2])
+    third = g.download_emails(msgs)
+    assert third == second
+    assert service.formats == {'full': 4, 'minimal': 2}
+
+
+def test_download_emails_gives_up():
+    ids = [junk() for _ in range(3)]
+    service = FakeService(throttle={ids[1]: 10})
+    g = gmail.Gmail(service=service)
+    g.backoff = gmail.Backoff(initial=0.)
+
+    emails = g.download_emails([{'id': i} for i in ids], max_retries=2)
+    assert [e['id'] for e in emails] == [ids[0], ids[2]]
+
+
+def test_download_pages_preserves_order():
+    pages = [[{'id': junk()}] for _ in range(5)]
+    g = gmail.Gmail(service=FakeService())
+    obs = list(g.download_pages(iter(pages)))
+    assert [[{'id': m['id']} for m in page] for page in obs] == pages
+
+
+def test_download_listed_pages():
+    pages = [[junk() for _ in range(7)] for _ in range(4)]
+    service = FakeService(pages=pages)
+    g = gmail.Gmail(service=service, batch_size=2, max_workers=4)
+
+    obs = list(g.download_pages(g.list_messages()))
+    assert [[m['id'] for m in page] for page in obs] == pages
+    # The service's one connection is never used by two threads at once
+    assert service.max_in_flight == 1
+
+
+def test_backoff_adapts():
+    b = gmail.Backoff(initial=1., maximum=4.)
+    b.throttled()
+    b.throttled()
+    b.throttled()
+    assert b.delay == 4.
+    b.succeeded()
+    assert b.delay == 2.
+    b.succeeded()
+    b.succeeded()
+    assert b.delay == 0.
 
 
 # Utility function tests
@@ -108,3 +400,180 @@ def test_get_datetime():
     for tc in testcases:
         obs = gmail.get_datetime(tc.msg, tc.as_numpy)
         assert str(obs) == tc.exp
+
+
+def test_html_to_text():
+    html = ('<html><head><style>p {color: red}</style>'
+            '<script>var x = "<b>no</b>";</script></head>'
+            '<body><!-- hidden --><p>Fish &amp; Chips</p>'
+            '<table><tr><td>Daily&nbsp;Specials</td></tr></table>'
+            '</body></html>')
+    fast = gmail.html_to_text(html, 'fast')
+    assert fast == 'Fish & ChipsDaily\xa0Specials'
+    assert fast == gmail.html_to_text(html, 'bs4')
+    with pytest.raises(ValueError):
+        gmail.html_to_text(html, 'lxml')
+
+
+def test_html_to_text_keeps_literal_brackets():
+    html = '<p>a</p> 1 < 2 and 3 > 2'
+    assert gmail.html_to_text(html, 'fast') == 'a 1 < 2 and 3 > 2'
+    assert gmail.html_to_text(html, 'bs4') == 'a 1 < 2 and 3 > 2'
+
+
+@pytest.mark.parametrize('hostile', [
+    '<script>x' * 20000,
+    '<!--x' * 20000,
+    '<b x' * 20000,
+])
+def test_html_to_text_linear(hostile):
+    # Unclosed elements and tags used to be rescanned to the end each time
+    start = time.perf_counter()
+    gmail.html_to_text('<p>Hi</p>' + hostile, 'fast')
+    assert time.perf_counter() - start < 1.
+
+
+def test_parse_html_email():
+    data = base64.urlsafe_b64encode(b'<p>Hello<br>world</p>').decode()
+    assert gmail.parse_html_email(data) == 'Helloworld'
+
+
+def test_extract_texts():
+    payloads = [fake_message(str(i), 'text %d' % i)['payload']
+                for i in range(10)]
+    payloads[3] = {'mimeType': 'image/png'}
+    exp = [gmail.extract_gmail_text(p) for p in payloads]
+    assert exp[3] is None
+    assert gmail.extract_texts(payloads) == exp
+    assert gmail.extract_texts(payloads, workers=2, chunk_size=3) == exp
+
+
+def b64(text, charset='utf-8'):
+    return base64.urlsafe_b64encode(text.encode(charset)).decode()
+
+
+def test_extract_gmail_text_walks_whole_tree():
+    html = {'mimeType': 'text/html', 'body': {'data': b64('<p>html</p>')}}
+    plain = {'mimeType': 'text/plain', 'body': {'data': b64('plain')}}
+    attachment = {'mimeType': 'text/plain', 'filename': 'notes.txt',
+                  'body': {'attachmentId': 'x'}}
+    payload = {'mimeType': 'multipart/mixed', 'parts': [
+        {'mimeType': 'application/pdf', 'filename': 'a.pdf',
+         'body': {'attachmentId': 'y'}},
+        attachment,
+        {'mimeType': 'multipart/related', 'parts': [
+            {'mimeType': 'multipart/alternative', 'parts': [html, plain]},
+            {'mimeType': 'image/png', 'body': {'attachmentId': 'z'}},
+        ]},
+    ]}
+    # text/plain wins, wherever it is
+    assert gmail.extract_gmail_text(payload) == 'plain'
+    # ...else the first text/html part
+    payload['parts'][2]['parts'][0]['parts'].remove(plain)
+    assert gmail.extract_gmail_text(payload) == 'html'
+    payload['parts'][2]['parts'][0]['parts'].remove(html)
+    assert gmail.extract_gmail_text(payload) is None
+
+
+def test_extract_gmail_text_charsets():
+    part = {'mimeType': 'text/plain',
+            'headers': [{'name': 'Content-Type',
+                         'value': 'text/plain; charset="ISO-8859-1"'}],
+            'body': {'data': b64('café', 'latin-1')}}
+    assert gmail.extract_gmail_text(part) == 'café'
+    part['headers'][0]['value'] = 'text/plain; charset=bogus'
+    part['body']['data'] = b64('naïve')
+    assert gmail.extract_gmail_text(part) == 'naïve'
+
+
+class FakeLabelService:
+    """Serves a mailbox's labels, counting listings."""
+
+    def __init__(self, labels):
+        self.server = {l['id']: dict(l) for l in labels}
+        self.listings = 0
+        self._users = MagicMock()
+        labels_api = self._users.labels.return_value
+        labels_api.list.side_effect = self._list
+        labels_api.create.side_effect = self._create
+
+    def users(self):
+        return self._users
+
+    def _list(self, userId):
+        self.listings += 1
+        request = MagicMock()
+        request.execute.return_value = {
+            'labels': [dict(l) for l in self.server.values()]}
+        return request
+
+    def _create(self, userId, body):
+        request = MagicMock()
+        if any(l['name'] == body['name'] for l in self.server.values()):
+            resp = namedtuple('Response', ('status', 'reason'))(409, '')
+            request.execute.side_effect = errors.HttpError(resp, b'Exists')
+        else:
+            label = {'id': 'Label_%d' % len(self.server),
+                     'name': body['name']}
+            self.server[label['id']] = label
+            request.execute.return_value = dict(label)
+        return request
+
+
+def test_label_registry():
+    service = FakeLabelService([{'id': 'INBOX', 'name': 'INBOX'},
+                                {'id': 'Label_1', 'name': 'Work'}])
+    registry = gmail.LabelRegistry()
+    g = gmail.Gmail(service=service, label_registry=registry)
+    names = g.label_names
+    assert names == {'INBOX': 'INBOX', 'Work': 'Label_1'}
+    assert g.label_ids == {'INBOX': 'INBOX', 'Label_1': 'Work'}
+    # Another client for the same account shares the listing
+    other = gmail.Gmail(service=service, label_registry=registry)
+    assert other.label_ids['Label_1'] == 'Work'
+    assert service.listings == 1
+
+    # Created labels land in the maps already handed out
+    created = g.create_label('Work/New')
+    assert names['Work/New'] == created['id']
+    assert g.create_label('Work/New') == created
+    # A label made elsewhere costs one listing to find, not one per call
+    service.server['Label_9'] = {'id': 'Label_9', 'name': 'Elsewhere'}
+    assert g.create_label('Elsewhere')['id'] == 'Label_9'
+    assert g.create_label('Elsewhere')['id'] == 'Label_9'
+    assert service.listings == 2
+
+    # Renames and deletions are applied as a diff once the TTL expires
+    service.server['Label_1']['name'] = 'Job'
+    del service.server['Label_9']
+    registry.ttl = 0.
+    assert g.label_names is names
+    assert 'Work' not in names and names['Job'] == 'Label_1'
+    assert 'Label_9' not in g.label_ids
+
+
+def test_label_registry_shared():
+    key = ('creds.json', junk())
+    a = gmail.Gmail(user_id=key[1], credentials=key[0])
+    b = gmail.Gmail(user_id=key[1], credentials=key[0])
+    assert a.label_registry is b.label_registry
+    assert gmail.Gmail(user_id=junk()).label_registry is not a.label_registry
+    # Handed-in services may be different mailboxes under the same key
+    c = gmail.Gmail(user_id=key[1], credentials=key[0], service=MagicMock())
+    d = gmail.Gmail(user_id=key[1], credentials=key[0], service=MagicMock())
+    assert c.label_registry is not a.label_registry
+    assert c.label_registry is not d.label_registry
+
+
+def test_gmail_source_unknown_labels():
+    service = FakeLabelService([{'id': 'Label_1', 'name': 'Work'}])
+    g = gmail.Gmail(service=service)
+    assert g.label_ids == {'Label_1': 'Work'}
+    # Made after the listing, and deleted mid-download, respectively
+    service.server['Label_2'] = {'id': 'Label_2', 'name': 'New'}
+    messages = [fake_message('a', 'hi', ['Label_1', 'Label_2']),
+                fake_message('b', 'yo', ['Label_9'])]
+
+    df = gmail.GmailSource(gmail=g)._transform(messages)
+    assert list(df['labels']) == [['Work', 'New'], []]
+    assert service.listings == 2  # Refreshed once, not per message
@@ -1,10 +1,18 @@
+import numpy as np
 import pytest
 import pandas as pd
+from sklearn.feature_extraction.text import TfidfTransformer
 from sklearn.linear_model import SGDClassifier
+from sklearn.model_selection import StratifiedKFold
 from sklearn.naive_bayes import MultinomialNB
 
-from matchwell.measure import report, cv_scores
-from matchwell.models import build_pipeline, grid_search
+from matchwell import tree, util
+from matchwell.measure import cv_scores, hierarchical_scores, report
+from matchwell.models import (CachedGridSearch, HierarchicalClassifier,
+                              StreamingTfidfTransformer, build_features,
+                              build_pipeline, grid_search,
+                              grid_search_optimal_parameters, label_index,
+                              load_model, save_model, transform_chunks)
 
 
 @pytest.yield_fixture(scope='session')
@@ -47,3 +55,305 @@ def test_grid_search(X, y):
     # Report on grid search outcome
     print("Best score: %0.3f" % gs_clf.best_score_)
     cv_scores(gs_clf, X, y, plot=True)
+
+
+TOPICS = {
+    'Work/Builds': 'build failed pipeline test compile error',
+    'Work/Reviews': 'review comment approve patch diff merge',
+    'Home/Bills': 'invoice payment due balance electric bill',
+    'Home/Travel': 'flight hotel booking itinerary trip airport',
+}
+
+
+@pytest.fixture(scope='session')
+def corpus():
+    """Short documents drawn from each topic's vocabulary."""
+    X, y = [], []
+    for i in range(20):
+        for label, words in sorted(TOPICS.items()):
+            words = words.split()
+            X.append(' '.join(words[j % len(words)] for j in range(i, i + 4)))
+            y.append([label])
+    yield pd.Series(X), pd.Series(y)
+
+
+@pytest.mark.parametrize('n_jobs', [1, 2])
+def test_hierarchical_fit(corpus, n_jobs):
+    X, y = corpus
+    hc = HierarchicalClassifier(n_jobs=n_jobs).fit(X, y)
+    assert set(hc._tree.names) == {
+        tree.ROOT, 'Work', 'Home', 'Work/Builds', 'Work/Reviews',
+        'Home/Bills', 'Home/Travel'}
+    n_features = len(hc._features.named_steps['vect'].vocabulary_)
+    for i in range(1, len(hc._tree)):
+        # Every node model works off the one shared vocabulary
+        assert hc._models[i].coef_.shape == (1, n_features)
+        # Each node's model only saw documents under its parent
+        assert hc._priors[i] == pytest.approx(.5)
+
+
+def test_label_index():
+    index = label_index([['A/B'], ['C'], ['A/D', 'C'], []])
+    assert {k: list(v) for k, v in index.items()} == {
+        'A': [0, 2], 'A/B': [0], 'A/D': [2], 'C': [1, 2]}
+
+
+def test_label_index_interned():
+    y = [['A/B'], ['C'], ['A/D', 'C'], [], ['A/B/E']]
+    vocab = util.LabelVocabulary()
+    index = label_index(vocab.encode(y))
+    assert {k: list(v) for k, v in index.items()} == {
+        k: list(v) for k, v in label_index(y).items()}
+    # Ancestors are indexed without being interned
+    assert 'A' not in vocab
+
+
+def test_hierarchical_fit_interned(corpus):
+    X, y = corpus
+    labels = util.LabelVocabulary().encode(y)
+    hc = HierarchicalClassifier().fit(X, labels)
+    expected = HierarchicalClassifier().fit(X, y)
+    assert hc._tree.names == expected._tree.names
+    assert hc._priors == pytest.approx(expected._priors)
+
+
+def test_hierarchical_predict(corpus):
+    X, y = corpus
+    hc = HierarchicalClassifier().fit(X, y)
+    docs = pd.Series(['compile error in the build pipeline',
+                      'hotel booking for the airport flight'])
+    builds, travel = hc.predict(docs)
+
+    assert max(builds, key=builds.get) in ('Work', 'Work/Builds')
+    assert builds['Work/Builds'] > builds['Work/Reviews']
+    assert builds['Work'] > .5 > builds['Home']
+    # The Home branch was never descended into
+    assert 'Home/Bills' not in builds
+    assert travel['Home/Travel'] > travel['Home/Bills']
+    assert 'Work/Builds' not in travel
+
+
+def test_hierarchical_predict_beam(corpus):
+    X, y = corpus
+    # Without a threshold, only the beam limits the descent
+    hc = HierarchicalClassifier(threshold=0., beam_width=1).fit(X, y)
+    builds, = hc.predict(pd.Series(['compile error in the build pipeline']))
+    assert set(builds) == {'Work', 'Home', 'Work/Builds', 'Work/Reviews'}
+    hc.beam_width = None
+    builds, = hc.predict(pd.Series(['compile error in the build pipeline']))
+    assert len(builds) == 6
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_hierarchical_compile(corpus, sparse):
+    X, y = corpus
+    hc = HierarchicalClassifier(threshold=0.).fit(X, y)
+    exp = hc.predict(X)
+    if not sparse:  # Scoring every node compiles as needed
+        assert hc.decision_matrix(X).shape == (len(X), 6)
+    hc.compile(sparse=sparse)
+    assert hc.decision_matrix(X).shape == (len(X), len(hc._nodes))
+    obs = hc.predict(X)
+    for o, e in zip(obs, exp):
+        assert o.keys() == e.keys()
+        for n in o:
+            assert o[n] == pytest.approx(e[n])
+
+
+def test_compile_sparse_matches_dense(corpus):
+    X, y = corpus
+    work = y.map(lambda labels: labels[0].startswith('Work'))
+    # Top-level nodes only see one class per batch, so keep just a prior
+    hc = HierarchicalClassifier().fit(X[work], y[work])
+    hc.partial_fit(X[~work], y[~work])
+    W, b = hc.compile()._weights, hc._intercepts
+    hc.compile(sparse=True)
+    assert hc._weights.format == 'csc'
+    assert (hc._weights.toarray() == W).all()
+    assert (hc._intercepts == b).all()
+
+
+def test_hierarchical_partial_fit(corpus):
+    X, y = corpus
+    work = y.map(lambda labels: labels[0].startswith('Work'))
+    hc = HierarchicalClassifier(threshold=0.).fit(X[work], y[work])
+    assert 'Home' not in hc._tree
+    hc.compile()
+
+    def node(name, attr='_models'):
+        return getattr(hc, attr)[hc._tree.ids[name]]
+
+    builds = node('Work/Builds').coef_.copy()
+    work_clf = node('Work')
+
+    hc.partial_fit(X[~work], y[~work])
+
+    assert {'Home', 'Home/Bills', 'Home/Travel'} <= set(hc._tree.names)
+    # No Work documents in the batch, so nothing below Work changed
+    assert (node('Work/Builds').coef_ == builds).all()
+    # ...but Work saw its first negatives, and is updated in place
+    assert node('Work') is work_clf
+    assert node('Work', '_priors') == pytest.approx(.5)
+    assert node('Home') is None
+    assert node('Home/Bills') is not None
+    assert len(hc._nodes) == 6
+
+    # Home's words aren't in the vocabulary, but its nodes are scored
+    travel, = hc.predict(pd.Series(['hotel booking for the airport flight']))
+    assert 'Home/Travel' in travel
+
+
+def test_streaming_tfidf(corpus):
+    X, _ = corpus
+    counts = build_features().named_steps['vect'].fit_transform(X)
+    exp = TfidfTransformer().fit_transform(counts)
+    tfidf = StreamingTfidfTransformer()
+    for i in range(0, counts.shape[0], 7):
+        tfidf.partial_fit(counts[i:i + 7])
+    assert abs(tfidf.transform(counts) - exp).max() < 1e-12
+    assert abs(tfidf.fit(counts).transform(counts) - exp).max() < 1e-12
+
+
+def test_transform_chunks(corpus):
+    X, _ = corpus
+    vect = build_features(hashing=True).named_steps['vect']
+    exp = vect.transform(X)
+    obs = transform_chunks(vect, X, chunk_size=15, n_jobs=2)
+    assert (obs != exp).nnz == 0
+
+
+def test_hierarchical_hashing_partial_fit(corpus):
+    X, y = corpus
+    work = y.map(lambda labels: labels[0].startswith('Work'))
+    hc = HierarchicalClassifier(hashing=True, n_features=2 ** 12)
+    hc.fit(X[work], y[work]).partial_fit(X[~work], y[~work])
+    # Unlike a fitted vocabulary, hashing picks up the new words too
+    travel, = hc.predict(pd.Series(['hotel booking for the airport flight']))
+    assert travel['Home/Travel'] > travel['Home/Bills']
+
+
+@pytest.mark.parametrize('hashing,sparse', [(False, False), (True, True)])
+def test_save_load_model(corpus, tmpdir, hashing, sparse):
+    X, y = corpus
+    X = X.copy()
+    X[0] += ' λογος'  # Terms outside ASCII survive the round trip
+    hc = HierarchicalClassifier(threshold=.2, hashing=hashing,
+                                n_features=2 ** 12).fit(X, y)
+    hc.compile(sparse=sparse)
+    path = str(tmpdir.join('model'))
+    save_model(path, hc)
+
+    loaded = load_model(path)
+    assert loaded.get_params() == hc.get_params()
+    assert list(loaded._tree.edges()) == list(hc._tree.edges())
+    if not sparse:
+        assert isinstance(loaded._weights, np.memmap)
+    for o, e in zip(loaded.predict(X), hc.predict(X)):
+        assert o.keys() == e.keys()
+        for n in o:
+            assert o[n] == pytest.approx(e[n])
+    if not hashing:
+        assert 'λογος' in loaded._features.named_steps['vect'].vocabulary
+    with pytest.raises(ValueError):
+        loaded.partial_fit(X, y)
+    # Refitting makes a loaded model an ordinary, updatable one
+    loaded.fit(X, y).partial_fit(X[:8], y[:8])
+
+
+def test_cached_grid_search_imbalanced():
+    # 54 of one class to 6 of the other, raced from a handful of rows
+    X = pd.Series(['build failed again %d' % i for i in range(54)] +
+                  ['hotel booking %d' % i for i in range(6)])
+    y = pd.Series(['Work'] * 54 + ['Home'] * 6)
+    params = {'clf__alpha': np.logspace(-5, 3, 9)}
+    pl = build_pipeline(SGDClassifier(max_iter=5, tol=None, random_state=0))
+    gs = CachedGridSearch(pl, params, cv=3, halving=True, n_jobs=1)
+    gs.fit(X, y)
+    assert min(r['n_resources'] for r in gs.cv_results_) == 4
+
+
+@pytest.mark.parametrize('hashing', [False, True])
+def test_resave_loaded_model(corpus, tmpdir, hashing):
+    X, y = corpus
+    hc = HierarchicalClassifier(hashing=hashing, n_features=2 ** 12)
+    hc.fit(X, y).compile()
+    save_model(str(tmpdir.join('first')), hc)
+    loaded = load_model(str(tmpdir.join('first')))
+    exp = loaded.decision_matrix(X)
+
+    # Compiling a loaded model only changes how its weights are held
+    loaded.compile(sparse=True)
+    assert loaded._weights.format == 'csc'
+    assert loaded.decision_matrix(X) == pytest.approx(exp)
+    save_model(str(tmpdir.join('second')), loaded)
+    again = load_model(str(tmpdir.join('second')))
+    assert again.decision_matrix(X) == pytest.approx(exp)
+
+
+def test_save_load_model_pickles_others(tmpdir):
+    path = str(tmpdir.join('model.pkl'))
+    save_model(path, {'not': 'hierarchical'})
+    assert load_model(path) == {'not': 'hierarchical'}
+
+
+@pytest.mark.parametrize('halving', [False, True])
+def test_cached_grid_search(corpus, halving):
+    X, y = corpus
+    y = y.map(lambda labels: labels[0])
+    params = {
+        'vect__ngram_range': [(1, 1), (1, 2)],
+        'tfidf__use_idf': (True, False),
+        'clf__alpha': (1e-4, 1e-2, 10.),
+    }
+    pl = build_pipeline(SGDClassifier(max_iter=5, tol=None, random_state=0))
+    gs = CachedGridSearch(pl, params, cv=3, halving=halving, n_jobs=2)
+    gs.fit(X, y)
+
+    # Four feature settings, vectorized once per fold
+    assert gs.n_feature_fits_ == 4 * 3
+    assert gs.best_score_ == pytest.approx(1.)
+    assert grid_search_optimal_parameters(gs) == gs.best_params_
+    assert gs.best_estimator_.predict(X[:4]).shape == (4,)
+    if halving:
+        rounds = sorted({r['n_resources'] for r in gs.cv_results_})
+        assert len(rounds) == 3 and rounds[-1] == 53
+        assert sum(r['iteration'] == 2 for r in gs.cv_results_) == 2
+    else:
+        assert len(gs.cv_results_) == 12
+
+
+def test_cv_scores_pipeline(corpus):
+    X, y = corpus
+    y = y.map(lambda labels: labels[0])
+    pl = build_pipeline(SGDClassifier(max_iter=5, tol=None, random_state=0))
+    scores = cv_scores(pl, X, y, cv=4, n_jobs=2)
+    assert set(scores) == {'score', 'fit_time', 'score_time',
+                           'vectorize_time'}
+    assert scores['score'].shape == (4,)
+    assert scores['score'].mean() > .5
+    # Plain lists and splitter objects work too
+    folds = StratifiedKFold(n_splits=2, shuffle=True, random_state=0)
+    scores = cv_scores(pl, list(X), list(y), cv=folds, n_jobs=1)
+    assert scores['score'].shape == (2,)
+
+
+@pytest.mark.parametrize('ragged', [False, True])
+def test_cv_scores_hierarchical(corpus, ragged):
+    X, y = corpus
+    # Plain lists of label lists, as fit takes them, ragged or not
+    y = [labels + ['Extra'] * (ragged and i % 3 == 0)
+         for i, labels in enumerate(y)]
+    scores = cv_scores(HierarchicalClassifier(), list(X), y, cv=3, n_jobs=2)
+    assert {'precision', 'recall', 'f1', 'fit_time'} <= set(scores)
+    assert scores['f1'].mean() > .5
+
+
+def test_hierarchical_scores():
+    y_true = [['A/B'], ['C']]
+    predictions = [{'A': .9, 'A/B': .2, 'A/D': .6, 'C': .1},
+                   {'A': .1, 'C': .8}]
+    scores = hierarchical_scores(y_true, predictions)
+    # Predicted {A, A/D} & {C}; true {A, A/B} & {C}
+    assert scores['precision'] == pytest.approx(2 / 3)
+    assert scores['recall'] == pytest.approx(2 / 3)
+    assert scores['f1'] == pytest.approx(2 / 3)
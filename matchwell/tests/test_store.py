@@ -0,0 +1,70 @@
+import pandas as pd
+import pytest
+
+from matchwell import util
+from matchwell.store import MessageStore
+
+pytest.importorskip('pyarrow')
+
+
+def frame(rows):
+    """Build a message frame from (id, timestamp, type) tuples."""
+    df = util.new_data_frame()
+    for msg_id, ts, typ in rows:
+        df.loc[len(df)] = [pd.Timestamp(ts), typ, msg_id, {'id': msg_id},
+                           'text of ' + msg_id, ['A', 'A/B']]
+    df['timestamp'] = pd.to_datetime(df['timestamp'])
+    return df
+
+
+@pytest.fixture()
+def store(tmpdir):
+    s = MessageStore(str(tmpdir))
+    s.append(frame([
+        ('a', '2016-06-01 10:00', 'gmail'),
+        ('b', '2016-06-01 12:00', 'gmail'),
+        ('c', '2016-06-03 09:00', 'gmail'),
+        ('d', '2016-06-02 09:00', 'sms'),
+    ]))
+    yield s
+
+
+def test_append_dedupes(store):
+    written = store.append(frame([
+        ('a', '2016-06-01 10:00', 'gmail'),
+        ('e', '2016-06-04 10:00', 'gmail'),
+        ('e', '2016-06-04 10:00', 'gmail'),
+    ]))
+    assert written == 1
+    assert len(store) == 5
+    assert sorted(store.read()['id']) == ['a', 'b', 'c', 'd', 'e']
+
+
+def test_read_roundtrip(store):
+    df = store.read(types=['gmail'])
+    assert list(df.columns) == list(util.new_data_frame().columns)
+    row = df[df['id'] == 'b'].iloc[0]
+    assert row['raw'] == {'id': 'b'}
+    assert list(row['labels']) == ['A', 'A/B']
+    assert row['timestamp'] == pd.Timestamp('2016-06-01 12:00')
+
+
+def test_read_time_range_projection(store):
+    df = store.read(columns=['id', 'labels'],
+                    start='2016-06-01 11:00', end='2016-06-03')
+    assert list(df.columns) == ['id', 'labels']
+    assert sorted(df['id']) == ['b', 'd']
+
+
+def test_persists(store):
+    reopened = MessageStore(store.root)
+    assert len(reopened) == 4
+    assert reopened.append(frame([('a', '2016-06-01 10:00', 'gmail')])) == 0
+
+
+def test_newest(store, tmpdir):
+    assert util.newest(store) == pd.Timestamp('2016-06-03 09:00')
+    assert util.newest(store, format=True) == '2016/06/03'
+    empty = MessageStore(str(tmpdir.join('empty')))
+    assert empty.newest() is None
+    assert util.newest(empty, format=True) is None
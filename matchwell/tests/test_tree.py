@@ -1,4 +1,9 @@
 import networkx as nx
+import numpy as np
+import pandas as pd
+import pytest
+
+from matchwell import tree
 
 
 TEST_EDGES = (
@@ -13,3 +18,50 @@ TEST_EDGES = (
 )
 
 TEST_TREE = nx.DiGraph(TEST_EDGES)
+
+
+def test_ancestry():
+    assert tree.ancestry(['A/B/E', 'A/C', 'G']) == {
+        'A', 'A/B', 'A/B/E', 'A/C', 'G'}
+    assert tree.ancestry([]) == set()
+
+
+def test_array_tree():
+    T = tree.ArrayTree.from_labels(['A/B/E', 'A/B/F', 'A/C', 'A/D/G', 'X'])
+    assert T.names == ['', 'A', 'X', 'A/B', 'A/C', 'A/D', 'A/B/E', 'A/B/F',
+                       'A/D/G']
+    assert list(T.parent) == [-1, 0, 0, 1, 1, 1, 3, 3, 5]
+    assert list(T.depth) == [0, 1, 1, 2, 2, 2, 3, 3, 3]
+    assert [T.names[c] for c in T.children(T.ids['A'])] == [
+        'A/B', 'A/C', 'A/D']
+    assert list(T.children(T.ids['A/C'])) == []
+    under_b = T.is_descendant(np.arange(len(T)), T.ids['A/B'])
+    assert [T.names[i] for i in np.flatnonzero(under_b)] == [
+        'A/B', 'A/B/E', 'A/B/F']
+    assert T.is_descendant(np.arange(len(T)), 0).all()
+
+    G = T.to_networkx()
+    assert set(G.successors('A/D')) == {'A/D/G'}
+    assert tree.ArrayTree.from_networkx(G).names == T.names
+    with pytest.raises(ValueError):
+        T.parent[1] = 2
+    # Node IDs have to be breadth-first for the child offsets to hold
+    with pytest.raises(ValueError):
+        tree.ArrayTree(['', 'A', 'A/B', 'C'], [-1, 0, 1, 0])
+
+
+def test_label_edges():
+    edges = list(tree.label_edges(['A/B/C', 'A/B', 'D', 'A/E/F']))
+    assert edges == [('', 'A'), ('A', 'A/B'), ('A/B', 'A/B/C'), ('', 'D'),
+                     ('A', 'A/E'), ('A/E', 'A/E/F')]
+    # Labels may contain the default delimiter when another is used
+    assert tree.build_prefix_tree(['a.b/c', 'a.d'], delim='.') == {
+        'a': {'a.b/c': {}, 'a.d': {}}}
+
+
+def test_column_edges():
+    column = pd.Series([['A/B', 'C'], [], ['A/B', 'A/D']] * 100)
+    assert sorted(tree.column_edges(column)) == [
+        ('', 'A'), ('', 'C'), ('A', 'A/B'), ('A', 'A/D')]
+    T = tree.ArrayTree.from_label_column(column)
+    assert T.names == ['', 'A', 'C', 'A/B', 'A/D']
@@ -1,6 +1,7 @@
 import random
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
 import pytest
 
@@ -48,6 +49,16 @@ def test_newest(df):
     assert util.newest(df, format=True) == "2016/08/08"
 
 
+def test_apply_delta():
+    df = pd.DataFrame({'id': ['a', 'b', 'c'], 'text': ['1', '2', '3']})
+    delta = pd.DataFrame({'id': ['b', 'c', 'd'],
+                          'text': ['2*', None, '4'],
+                          'change': ['labels', 'deleted', 'added']})
+    merged = util.apply_delta(df, delta)
+    assert sorted(zip(merged['id'], merged['text'])) == [
+        ('a', '1'), ('b', '2*'), ('d', '4')]
+
+
 def test_collapse_unique():
     # Build a list of randomly sampled subsets of the master list
     l = [random.sample(TEST_LABELS, random.randint(0, len(TEST_LABELS)-1))
@@ -55,6 +66,19 @@ def test_collapse_unique():
     assert sorted(list(util.collapse_unique(l))) == sorted(TEST_LABELS)
 
 
+def test_filter_children():
+    labels = TEST_LABELS + ['A/Two words', 'A/D/x-y', 'A/D/x-y/z']
+    assert list(util.filter_children(labels, '')) == ['A']
+    assert list(util.filter_children(labels, 'A')) == [
+        'A/B', 'A/C', 'A/D', 'A/Two words']
+    index = util.child_index(labels)
+    assert list(util.filter_children(index, 'A/D')) == [
+        'A/D/G', 'A/D/H', 'A/D/I', 'A/D/x-y']
+    assert list(util.filter_children(index, 'A/C')) == []
+    assert util.filter_children_many(labels, ['A/B', 'A/D/x-y', 'Z']) == {
+        'A/B': ['A/B/E', 'A/B/F'], 'A/D/x-y': ['A/D/x-y/z'], 'Z': []}
+
+
 def test_build_prefix_tree():
     exp = {
         'A': {
@@ -71,3 +95,24 @@ def test_build_prefix_tree():
         }
     }
     assert tree.build_prefix_tree(TEST_LABELS) == exp
+
+
+def test_label_vocabulary():
+    vocab = util.LabelVocabulary()
+    col = vocab.encode([['A/B', 'C'], [], ['C'], ['A/D', 'A/B']])
+    assert vocab.names == ['A/B', 'C', 'A/D']
+    assert list(col.offsets) == [0, 2, 2, 3, 5]
+    assert col.values.dtype == np.int32
+    assert col.decode() == [['A/B', 'C'], [], ['C'], ['A/D', 'A/B']]
+    assert list(col[-1]) == [2, 0]
+
+    assert list(col.has_any(['C', 'missing'])) == [True, False, True, False]
+    assert col.indicator().toarray().tolist() == [
+        [True, True, False], [False] * 3, [False, True, False],
+        [True, False, True]]
+    sub = col[np.array([3, 1, 0])]
+    assert sub.decode() == [['A/D', 'A/B'], [], ['A/B', 'C']]
+    assert col[1:3].decode() == [[], ['C']]
+
+    assert util.collapse_unique(col) == {0, 1, 2}
+    assert util.intersection(col[0], col[3]) == {0}
@@ -3,27 +3,57 @@ tree.py
 =======
 Provides utilities for working with a tree of string labels.
 """
+import itertools
+
 import networkx as nx
+import numpy as np
+
+#: Name of the node every label tree hangs from.
+ROOT = ''
 
 
 # General-purpose tree tools
 def build_prefix_tree(words, delim='/'):
     """Create a prefix tree using nested dictionaries."""
     trie = {}
-    for w in words:
-        # print("Splitting", w)
-        parts = w.split(delim)
-        d = trie  # Essentially a pointer within our tree.
-        for i in range(len(parts)):
-            # print("\tPlacing", p)
-            p = '/'.join(parts[:i+1])
-            d.setdefault(p, {})
-            d = d[p]
-        d = trie  # Reset to top-level dict
-        # print(d)
+    nodes = {ROOT: trie}  # Every node's dict, by full label
+    for parent, child in label_edges(words, delim):
+        nodes[child] = nodes[parent].setdefault(child, {})
     return trie
 
 
+def label_edges(labels, delim='/'):
+    """Yield each (parent, child) edge of the tree holding `labels`, once.
+
+    Labels hang from :data:`ROOT`, and missing ancestors are filled in. A
+    parent's edge always comes before its children's. Each new node costs
+    one :meth:`str.rpartition`, and a label already seen costs a single
+    lookup, so this is linear in the total length of the labels.
+
+    >>> list(label_edges(['A/B/C', 'A/D']))
+    [('', 'A'), ('A', 'A/B'), ('A/B', 'A/B/C'), ('A', 'A/D')]
+    """
+    seen = {ROOT}
+    for label in labels:
+        missing = []
+        while label not in seen:
+            seen.add(label)
+            missing.append(label)
+            label = label.rpartition(delim)[0]  # ROOT above the top level
+        for child in reversed(missing):
+            yield label, child
+            label = child
+
+
+def column_edges(column, delim='/'):
+    """Like :func:`label_edges`, for a frame's column of label lists.
+
+    Labels repeat across many rows, so they're deduplicated before any
+    splitting is done.
+    """
+    return label_edges(set(itertools.chain.from_iterable(column)), delim)
+
+
 def walk(val, level=0, leaves=True):
     """Walk a structure made of a dicts/lists."""
     if isinstance(val, dict):
@@ -55,15 +85,28 @@ def ancestral_walk(struct):
         yield (stack[i], stack[i+1])
 
 
+def ancestry(labels, delim='/'):
+    """Return the labels along with every ancestor of each.
+
+    >>> sorted(ancestry(['A/B/C', 'D']))
+    ['A', 'A/B', 'A/B/C', 'D']
+    """
+    found = set()
+    for label in labels:
+        parts = label.split(delim)
+        prefix = parts[0]
+        found.add(prefix)
+        for part in parts[1:]:
+            prefix += delim + part
+            found.add(prefix)
+    return found
+
+
 # NetworkX
-def from_labels(labels):
+def from_labels(labels, delim='/'):
     """Create a :class:`networkx.DiGraph` from a list of labels."""
-    # Isolate unique labels
-    label_tree = build_prefix_tree(labels)
-    edges = ancestral_walk(label_tree)
-    # Build a tree from labels
     T = nx.DiGraph()
-    T.add_edges_from(edges)
+    T.add_edges_from(label_edges(labels, delim))
     return T
 
 
@@ -72,3 +115,128 @@ def find_root(G):
     if not nx.is_tree(G):
         return None
     return nx.topological_sort(G)[0]
+
+
+# Arrays
+class ArrayTree:
+    """An immutable label tree held in flat integer arrays.
+
+    Nodes are numbered breadth-first from the root, 0, visiting children in
+    name order. So every parent's ID is smaller than its children's, and
+    each node's children have consecutive IDs.
+
+    Attributes:
+        names (List[str]): Node name by ID.
+        ids (dict[str, int]): Node ID by name.
+        parent (numpy.ndarray): Parent ID by ID; -1 for the root.
+        depth (numpy.ndarray): Distance from the root by ID.
+        child_ptr (numpy.ndarray): The children of node ``i`` are IDs
+            ``child_ptr[i]`` up to ``child_ptr[i + 1]``, CSR style.
+        preorder (numpy.ndarray): Depth-first position by ID; a node's
+            subtree occupies positions ``preorder[i]`` up to
+            ``preorder[i] + size[i]``.
+        size (numpy.ndarray): Number of nodes in each subtree, itself
+            included.
+    """
+
+    def __init__(self, names, parent):
+        """
+        Args:
+            names (List[str]): Node names, in breadth-first order, as
+                :meth:`from_edges` numbers them.
+            parent (Sequence[int]): Parent ID of each; -1 for the root.
+        Raises:
+            ValueError: If the nodes aren't numbered breadth-first, i.e.
+                the root first and then every node after its parent, with
+                siblings side by side.
+        """
+        n = len(names)
+        self.names = list(names)
+        self.ids = {name: i for i, name in enumerate(self.names)}
+        self.parent = np.asarray(parent, dtype=np.int32)
+        if len(self.parent) != n or n == 0 or self.parent[0] != -1 or \
+                (self.parent[1:] >= np.arange(1, n)).any() or \
+                (np.diff(self.parent[1:]) < 0).any():
+            raise ValueError("Tree nodes must be numbered breadth-first")
+        self.depth = np.zeros(n, dtype=np.int32)
+        for i in range(1, n):
+            self.depth[i] = self.depth[self.parent[i]] + 1
+        n_children = np.bincount(self.parent[1:], minlength=n)
+        # Children follow all of the nodes before their parent's first child
+        self.child_ptr = np.r_[1, 1 + np.cumsum(n_children)].astype(np.int32)
+        self.size = np.ones(n, dtype=np.int32)
+        for i in range(n - 1, 0, -1):
+            self.size[self.parent[i]] += self.size[i]
+        self.preorder = np.zeros(n, dtype=np.int32)
+        for i in range(n):
+            pos = self.preorder[i] + 1
+            for child in range(self.child_ptr[i], self.child_ptr[i + 1]):
+                self.preorder[child] = pos
+                pos += self.size[child]
+        for arr in (self.parent, self.depth, self.child_ptr, self.size,
+                    self.preorder):
+            arr.setflags(write=False)
+
+    @classmethod
+    def from_edges(cls, edges, root=ROOT):
+        """Build from (parent, child) name pairs."""
+        children = {}
+        for parent, child in edges:
+            children.setdefault(parent, []).append(child)
+        names, parents = [root], [-1]
+        i = 0
+        while i < len(names):  # Breadth-first
+            for child in sorted(children.get(names[i], ())):
+                names.append(child)
+                parents.append(i)
+            i += 1
+        return cls(names, parents)
+
+    @classmethod
+    def from_labels(cls, labels, delim='/'):
+        """Build from labels, adding any missing ancestors."""
+        return cls.from_edges(label_edges(labels, delim))
+
+    @classmethod
+    def from_label_column(cls, column, delim='/'):
+        """Build from a frame's column of label lists."""
+        return cls.from_edges(column_edges(column, delim))
+
+    @classmethod
+    def from_networkx(cls, G, root=ROOT):
+        return cls.from_edges(G.edges(), root)
+
+    def to_networkx(self):
+        """Returns the tree as a :class:`networkx.DiGraph`, e.g. to draw."""
+        T = nx.DiGraph()
+        T.add_node(self.names[0])
+        T.add_edges_from(self.edges())
+        return T
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def edges(self):
+        """Yields (parent, child) name pairs."""
+        for i in range(1, len(self)):
+            yield self.names[self.parent[i]], self.names[i]
+
+    def children(self, i):
+        """Returns the IDs of node `i`'s children."""
+        return np.arange(self.child_ptr[i], self.child_ptr[i + 1])
+
+    def is_descendant(self, nodes, ancestor):
+        """Test which of `nodes` lie in `ancestor`'s subtree, itself included.
+
+        Args:
+            nodes (numpy.ndarray): Node IDs.
+            ancestor (int): Node ID.
+        Returns:
+            numpy.ndarray of bools.
+        """
+        pos = self.preorder[nodes]
+        start = self.preorder[ancestor]
+        return (pos >= start) & (pos < start + self.size[ancestor])
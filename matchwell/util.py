@@ -1,8 +1,9 @@
-import re
 import itertools
-from collections import Iterable
+from collections.abc import Iterable
 
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 
 
 def new_data_frame():
@@ -20,9 +21,33 @@ def new_data_frame():
     )
 
 
+def apply_delta(df, delta):
+    """Merge a delta frame, as from :meth:`GmailSource.sync`, into `df`.
+
+    Rows sharing an ``id`` with the delta are replaced by the delta's
+    version, and rows the delta marks as 'deleted' are dropped.
+
+    Returns:
+        A new :class:`pandas.DataFrame`.
+    """
+    kept = df[~df['id'].isin(delta['id'])]
+    updated = delta[delta['change'] != 'deleted'].drop('change', axis=1)
+    return pd.concat([kept, updated])
+
+
 def newest(df, format=False):
-    """Return the newest timestamp from a :class:`pandas.DataFrame`."""
-    ts = df.sort_index(ascending=False).index[0]
+    """Return the newest timestamp from a :class:`pandas.DataFrame`.
+
+    A :class:`matchwell.store.MessageStore` may be passed instead, in which
+    case the answer comes from its metadata without reading any rows, and
+    is None while the store is empty.
+    """
+    if isinstance(df, pd.DataFrame):
+        ts = df.sort_index(ascending=False).index[0]
+    else:
+        ts = df.newest()
+    if ts is None:
+        return None
     if format:
         return ts.strftime("%Y/%m/%d")
     return ts
@@ -50,12 +75,17 @@ def contains_substrings(substrs, coll, inverse=False):
 def intersection(a, b):
     """Return the intersection between `str` in A and B.
 
+    Interned label IDs work too: if either side is an array of IDs, the
+    intersection is found with a sorted merge rather than hashing.
+
     Args:
         a (List[str]): List of strings.
         b (List[str]): List of strings.
     Returns:
         Set[str]
     """
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        return set(np.intersect1d(a, b).tolist())
     return set(a).intersection(set(b))
 
 
@@ -69,30 +99,197 @@ def iterable_or_string(val):
     return is_iter, is_string
 
 
-def filter_children(labels, parent):
+def filter_children(labels, parent, delim='/'):
     """Filters for immediate descendents of a parent within a label list.
 
     Args:
         labels (List[str]): List of labels, with their ancestry denoted by
-            slashes within.
+            slashes within. A prebuilt :func:`child_index` may be passed
+            instead, which answers without scanning the labels.
         parent (str): Parent label to filter direct descendents on.
+        delim (str): Separator between a label's ancestors.
 
     Returns:
         List[str] of child labels.
     """
-    pat = parent
-    if pat != '':  # Root node check
-        pat += '/'
-    p = re.compile(pat + r'\w+$')
+    if isinstance(labels, dict):
+        yield from labels.get(parent, ())
+        return
     for l in labels:
-        m = p.match(l)
-        if m is not None:
+        if l.rpartition(delim)[0] == parent:
             yield l
 
 
+def child_index(labels, delim='/'):
+    """Index labels by their parent, in one pass.
+
+    Top-level labels are filed under the root, ''. Any character other
+    than `delim` may appear in a label.
+
+    >>> child_index(['A', 'A/B', 'A/C-D'])
+    {'': ['A'], 'A': ['A/B', 'A/C-D']}
+
+    Returns:
+        dict[str, List[str]]: Direct children by parent, in input order.
+    """
+    index = {}
+    for l in labels:
+        index.setdefault(l.rpartition(delim)[0], []).append(l)
+    return index
+
+
+def filter_children_many(labels, parents, delim='/'):
+    """Batch version of :func:`filter_children`.
+
+    Returns:
+        dict[str, List[str]]: Direct children of each of `parents`.
+    """
+    if not isinstance(labels, dict):
+        labels = child_index(labels, delim)
+    return {p: labels.get(p, []) for p in parents}
+
+
 def collapse_unique(iter_of_iters):
-    """Collapse a iterable of iterables into a set of unique values."""
+    """Collapse a iterable of iterables into a set of unique values.
+
+    A :class:`LabelColumn` collapses to the set of label IDs it uses.
+    """
+    if isinstance(iter_of_iters, LabelColumn):
+        return set(np.unique(iter_of_iters.values).tolist())
     unique_labels = set()
     for l in itertools.chain.from_iterable(iter_of_iters):
         unique_labels.add(l)
     return unique_labels
+
+
+# Interned labels
+class LabelVocabulary:
+    """Interns label names as consecutive integer IDs.
+
+    Every row of a frame repeats full label paths like 'Work/Projects/Foo';
+    interning stores each name once, and lets a column of labels be held as
+    a :class:`LabelColumn` of small integers.
+
+    Attributes:
+        names (List[str]): Label name by ID.
+        ids (dict[str, int]): Label ID by name.
+    """
+
+    def __init__(self, names=()):
+        self.names = []
+        self.ids = {}
+        for name in names:
+            self.add(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def add(self, name):
+        """Returns the ID of `name`, interning it if it's new."""
+        i = self.ids.get(name)
+        if i is None:
+            i = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return i
+
+    def lookup(self, names):
+        """Returns the IDs of known `names` as an array; unknowns are left
+        out."""
+        return np.array([self.ids[n] for n in names if n in self.ids],
+                        dtype=np.int32)
+
+    def decode(self, ids):
+        """Returns the names of label `ids`."""
+        return [self.names[i] for i in ids]
+
+    def encode(self, rows):
+        """Intern a column of label lists, such as a frame's 'labels'.
+
+        Args:
+            rows (Iterable[List[str]]): Labels per row.
+        Returns:
+            :class:`LabelColumn`
+        """
+        add = self.add
+        offsets, values = [0], []
+        for labels in rows:
+            values.extend(map(add, labels))
+            offsets.append(len(values))
+        return LabelColumn(self, np.array(offsets, dtype=np.int64),
+                           np.array(values, dtype=np.int32))
+
+
+class LabelColumn:
+    """Label IDs per row, stored ragged in two flat arrays.
+
+    Row ``i``'s labels are ``values[offsets[i]:offsets[i + 1]]``, which is
+    also the layout of a CSR matrix; see :meth:`indicator`.
+
+    Indexing with an integer returns that row's IDs, and with a slice or an
+    array of rows returns a new column, so a column can stand in for
+    ``y`` wherever rows are selected by position.
+
+    Attributes:
+        vocabulary (LabelVocabulary): Names for the IDs.
+        offsets (numpy.ndarray): Start of each row in `values`, plus the end.
+        values (numpy.ndarray): int32 label IDs, row after row.
+    """
+
+    def __init__(self, vocabulary, offsets, values):
+        self.vocabulary = vocabulary
+        self.offsets = offsets
+        self.values = values
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def __getitem__(self, rows):
+        if isinstance(rows, (int, np.integer)):
+            i = range(len(self))[rows]
+            return self.values[self.offsets[i]:self.offsets[i + 1]]
+        rows = np.arange(len(self))[rows]
+        starts, ends = self.offsets[rows], self.offsets[rows + 1]
+        lengths = ends - starts
+        offsets = np.r_[0, np.cumsum(lengths)]
+        # Position of every kept value in the old values array
+        take = np.repeat(starts - offsets[:-1], lengths) + \
+            np.arange(offsets[-1])
+        return LabelColumn(self.vocabulary, offsets, self.values[take])
+
+    @property
+    def nbytes(self):
+        return self.offsets.nbytes + self.values.nbytes
+
+    def row_ids(self):
+        """Returns the row each of :attr:`values` belongs to."""
+        return np.repeat(np.arange(len(self)), np.diff(self.offsets))
+
+    def indicator(self):
+        """Returns a boolean (rows, labels) :class:`scipy.sparse.csr_matrix`,
+        sharing this column's arrays."""
+        return sp.csr_matrix(
+            (np.ones(len(self.values), dtype=bool), self.values, self.offsets),
+            shape=(len(self), len(self.vocabulary)))
+
+    def has_any(self, labels):
+        """Returns a boolean mask of the rows carrying any of `labels`.
+
+        Args:
+            labels: Label names, or an array of label IDs.
+        """
+        if not isinstance(labels, np.ndarray):
+            labels = self.vocabulary.lookup(labels)
+        hits = self.row_ids()[np.isin(self.values, labels)]
+        return np.bincount(hits, minlength=len(self)) > 0
+
+    def decode(self):
+        """Returns the label names per row, as lists."""
+        names = self.vocabulary.names
+        return [[names[i] for i in row] for row in self]
@@ -34,6 +34,7 @@ setup(
     tests_require=tests_require,
     extras_require={
         'test': tests_require,
+        'store': ['pyarrow>=0.8'],
     },
     zip_safe=False,
     include_package_data=True